@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""Admission control for the RESTful Open Annotation explorer.
+
+Requests are assigned to cost classes by their estimated cost, and
+each class has its own limit on concurrent requests and a bounded
+queue of waiting ones. Requests that find the queue full or wait too
+long are rejected so that the server can shed load instead of
+letting expensive requests starve cheap ones.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import time
+import threading
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+# Cost class parameters. Requests with estimated cost up to max_cost
+# (None for no limit) belong to the class. At most concurrency
+# requests of the class are processed at a time and at most
+# queue_size wait for up to timeout seconds. Rejected clients are
+# asked to retry after retry_after seconds.
+CostClass = namedtuple('CostClass', 'name max_cost concurrency queue_size '
+                       'timeout retry_after')
+
+DEFAULT_COST_CLASSES = [
+    CostClass('light', 100000, 32, 64, 5, 1),
+    CostClass('medium', 2000000, 8, 16, 10, 5),
+    CostClass('heavy', None, 2, 4, 30, 30),
+]
+
+# Relative cost of one annotation compared to one character of text.
+ANNOTATION_COST = 100
+
+class Overloaded(Exception):
+    """Raised when a request is not admitted."""
+    def __init__(self, cost_class):
+        Exception.__init__(self, 'too many %s requests' % cost_class.name)
+        self.retry_after = cost_class.retry_after
+
+def estimate_cost(annotation_count=None, text_length=None):
+    """Return estimated cost of visualizing a document with given
+    number of annotations and text length, or None if both are
+    unknown."""
+    if annotation_count is None and text_length is None:
+        return None
+    return (annotation_count or 0) * ANNOTATION_COST + (text_length or 0)
+
+class _Gate(object):
+    """Concurrency limit with a bounded queue for one cost class."""
+
+    def __init__(self, cost_class):
+        self.cost_class = cost_class
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Return True if admitted, False if rejected."""
+        c = self.cost_class
+        with self._condition:
+            if self.active >= c.concurrency and self.waiting >= c.queue_size:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                deadline = time.time() + c.timeout
+                while self.active >= c.concurrency:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self._condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+class AdmissionController(object):
+    """Per-cost-class concurrency limits with bounded queues.
+
+    Requests of unknown cost are assigned to the default class, the
+    second cheapest by default.
+    """
+
+    def __init__(self, cost_classes=DEFAULT_COST_CLASSES, default=None):
+        self.cost_classes = cost_classes
+        self._gates = { c.name: _Gate(c) for c in cost_classes }
+        if default is None:
+            default = cost_classes[min(1, len(cost_classes)-1)].name
+        self.default = default
+
+    def default_cost(self):
+        """Return the least cost in the default class, for adding up
+        the costs of requests including some of unknown cost."""
+        cost = 0
+        for c in self.cost_classes:
+            if c.name == self.default:
+                break
+            cost = c.max_cost + 1
+        return cost
+
+    def classify(self, cost):
+        """Return the CostClass for given estimated cost."""
+        if cost is None:
+            return self._gates[self.default].cost_class
+        for c in self.cost_classes:
+            if c.max_cost is None or cost <= c.max_cost:
+                return c
+        return self.cost_classes[-1]
+
+    @contextmanager
+    def admit(self, cost):
+        """Context manager admitting a request of given estimated cost,
+        waiting if necessary. Raises Overloaded if not admitted."""
+        gate = self._gates[self.classify(cost).name]
+        if not gate.acquire():
+            raise Overloaded(gate.cost_class)
+        try:
+            yield
+        finally:
+            gate.release()
+
+    def stats(self):
+        """Return dict of per-class counters."""
+        return {
+            name: {
+                'active': g.active,
+                'waiting': g.waiting,
+                'admitted': g.admitted,
+                'rejected': g.rejected,
+            } for name, g in self._gates.items()
+        }
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""Compare memory use of parsed and compact annotation collections.
+
+Generates a synthetic collection resembling RESTful OA store output,
+parses it as get_collection() does and reports bytes per annotation
+for the parsed JSON and for CompactAnnotations, checking that the
+annotations are reconstructed identically.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import os
+import sys
+import json
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from compact import CompactAnnotations
+
+TYPES = ['GO:%07d', 'DOID:%07d', 'taxonomy:%d',
+         'http://purl.obolibrary.org/obo/CHEBI_%d']
+
+def synthetic_annotations(count, documents=1000, seed=0):
+    """Return count annotations over given number of documents,
+    parsed from JSON."""
+    r = random.Random(seed)
+    annotations = []
+    for i in range(count):
+        start = r.randrange(10000)
+        annotation = {
+            '@id': 'http://example.org/annotations/%d' % i,
+            '@type': 'oa:Annotation',
+            'target': 'http://example.org/documents/%d#char=%d,%d' % (
+                r.randrange(documents), start, start+r.randrange(1, 20)),
+            'annotatedBy': 'http://example.org/tagger',
+        }
+        type_ = r.choice(TYPES) % r.randrange(1000)
+        if r.random() < 0.5:
+            annotation['body'] = type_
+        else:
+            annotation['body'] = { '@id': type_, 'label': 'T%s' % type_ }
+        annotations.append(annotation)
+    return json.loads(json.dumps(annotations))
+
+def deep_size(obj, seen=None):
+    """Return approximate size of object and objects reachable from
+    it in bytes, counting shared objects once."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen)
+                    for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(i, seen) for i in obj)
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    return size
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    annotations = synthetic_annotations(count)
+    compact = CompactAnnotations(annotations)
+    assert len(compact) == count
+    assert all(compact[i] == a for i, a in enumerate(annotations))
+    parsed_size = deep_size(annotations)
+    compact_size = deep_size(compact)
+    for name, size in (('parsed', parsed_size), ('compact', compact_size)):
+        print '%-8s %12d bytes, %6.1f bytes/annotation' % (
+            name, size, 1.*size/count)
+    print 'compact/parsed: %.2f' % (1.*compact_size/parsed_size)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
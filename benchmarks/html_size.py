@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""Compare size of full and compact so2html markup.
+
+Renders a synthetic document with dense annotations using ontology
+type URIs and reports bytes per span for both output modes.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import os
+import re
+import sys
+import random
+
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from so2html import standoff_to_html
+
+Standoff = namedtuple('Standoff', 'start end type')
+
+TYPE_PREFIXES = [
+    'http://purl.obolibrary.org/obo/GO_',
+    'http://purl.obolibrary.org/obo/CHEBI_',
+    'http://purl.obolibrary.org/obo/SO_',
+    'http://www.ncbi.nlm.nih.gov/taxonomy/',
+]
+
+def synthetic_document(span_count, seed=0):
+    """Return text and standoffs with span_count spans over it."""
+    r = random.Random(seed)
+    words = ['protein', 'binds', 'cell', 'in', 'the', 'mouse', 'gene']
+    text = ' '.join(r.choice(words) for i in range(span_count * 2))
+    standoffs = []
+    for i in range(span_count):
+        start = r.randrange(len(text) - 30)
+        end = start + r.randrange(3, 30)
+        type_ = r.choice(TYPE_PREFIXES) + '%07d' % r.randrange(1000)
+        standoffs.append(Standoff(start, end, type_))
+    return text, standoffs
+
+def tag_structure(html):
+    """Return body of page with tag attributes removed."""
+    body = html[html.index('<body'):]
+    return re.sub(r'<(/?\w+)[^>]*>', r'<\1>', body)
+
+def main(argv):
+    span_count = int(argv[1]) if len(argv) > 1 else 10000
+    text, standoffs = synthetic_document(span_count)
+    sizes = {}
+    pages = {}
+    for compact in (False, True):
+        html = standoff_to_html(text, standoffs, legend=True, tooltips=True,
+                                links=True, compact=compact)
+        pages[compact] = html
+        sizes[compact] = len(html.encode('utf-8'))
+    # Text and tag structure should not depend on the mode.
+    assert tag_structure(pages[False]) == tag_structure(pages[True])
+    base = len(text.encode('utf-8'))
+    for compact in (False, True):
+        print '%-8s %10d bytes, %6.1f bytes/span (excluding text)' % (
+            'compact' if compact else 'full', sizes[compact],
+            1.*(sizes[compact]-base)/span_count)
+    print 'compact/full: %.2f' % (1.*sizes[True]/sizes[False])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
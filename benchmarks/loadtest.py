@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+
+"""Load test for the RESTful Open Annotation explorer.
+
+Starts a local stub RESTful OA store and document text server,
+drives the explorer's /explore routes with a configurable request mix
+and concurrency, and reports throughput, latency percentiles and the
+memory use of the explorer processes.
+
+Example: start the explorer and run a mix of overview, list and
+visualization requests with 16 concurrent clients:
+
+    python benchmarks/loadtest.py --start -c 16 -n 2000 \\
+        --mix overview=1,list=1,visualize=4
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import os
+import sys
+import json
+import time
+import random
+import urllib
+import hashlib
+import argparse
+import threading
+import subprocess
+import urlparse
+
+from collections import defaultdict
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import requests
+
+EXPLORER = os.path.join(os.path.dirname(__file__), '..', 'oaexplorer.py')
+
+TYPES = ['GO:%07d', 'DOID:%07d', 'taxonomy:%d',
+         'http://purl.obolibrary.org/obo/CHEBI_%d']
+
+WORDS = ['protein', 'binds', 'to', 'the', 'receptor', 'in', 'mouse', 'cell']
+
+# Request kinds of --mix (see request_urls()).
+KINDS = ('overview', 'list', 'visualize', 'export')
+
+# Marks the start page shown with a warning when exploring fails; the
+# explorer returns it with status 200.
+ERROR_PAGE_MARKER = 'alert alert-warning'
+
+class StubStore(object):
+    """Generated collection of annotations on generated documents."""
+
+    def __init__(self, documents, annotations, text_length, seed=0):
+        r = random.Random(seed)
+        self.texts = []
+        for i in range(documents):
+            words, length = [], 0
+            while length < text_length:
+                words.append(r.choice(WORDS))
+                length += len(words[-1]) + 1
+            self.texts.append(u' '.join(words))
+        self.annotations = []
+        for i in range(documents):
+            text = self.texts[i]
+            for j in range(annotations):
+                start = r.randrange(max(1, len(text) - 20))
+                end = min(len(text), start + r.randrange(1, 20))
+                type_ = r.choice(TYPES) % r.randrange(1000)
+                self.annotations.append((i, start, end, type_))
+
+    def collection(self, base, page, page_size):
+        """Return collection page as JSON-LD dict."""
+        if page_size is None:
+            page_size = max(1, len(self.annotations))
+        last = max(0, (len(self.annotations) - 1) // page_size)
+        items = []
+        first = page * page_size
+        for k in range(first, min(first+page_size, len(self.annotations))):
+            i, start, end, type_ = self.annotations[k]
+            items.append({
+                '@id': '/annotations/%d' % k,
+                '@type': 'oa:Annotation',
+                'target': '%s/documents/%d#char=%d,%d' % (base, i, start, end),
+                'body': type_,
+            })
+        collection = { '@id': '/annotations', '@graph': items }
+        def link(p):
+            return '/annotations?page=%d' % p
+        collection['start'], collection['last'] = link(0), link(last)
+        if page > 0:
+            collection['prev'] = link(page-1)
+        if page < last:
+            collection['next'] = link(page+1)
+        return collection
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Serves /annotations and /documents/N from server.store."""
+
+    def log_message(self, format, *args):
+        pass # quiet
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        parsed = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(parsed.query)
+        if parsed.path == '/annotations':
+            page = int(query.get('page', ['0'])[0])
+            collection = server.store.collection(server.base, page,
+                                                 server.page_size)
+            self.respond(json.dumps(collection), 'application/ld+json')
+        elif parsed.path.startswith('/documents/'):
+            try:
+                text = server.store.texts[int(parsed.path.split('/')[-1])]
+            except (ValueError, IndexError):
+                return self.send_error(404)
+            if server.no_charset:
+                content_type = 'text/plain'
+            else:
+                content_type = 'text/plain; charset=utf-8'
+            self.respond(text.encode('utf-8'), content_type)
+        else:
+            self.send_error(404)
+
+    def respond(self, data, content_type):
+        etag = None
+        if self.server.etags:
+            etag = '"%s"' % hashlib.sha1(data).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def start_stub_server(store, port, latency=0, page_size=None, etags=True,
+                      no_charset=False):
+    server = StubServer(('127.0.0.1', port), StubHandler)
+    server.store = store
+    server.base = 'http://127.0.0.1:%d' % server.server_address[1]
+    server.latency = latency
+    server.page_size = page_size
+    server.etags = etags
+    server.no_charset = no_charset
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def request_urls(explorer, store_base, kind, documents):
+    """Return URL for a request of given kind."""
+    collection = store_base + '/annotations'
+    doc = '%s/documents/%d' % (store_base, random.randrange(documents))
+    params = [('url', collection)]
+    if kind == 'list':
+        params += [('doc', doc), ('style', 'list')]
+    elif kind == 'visualize':
+        params += [('doc', doc), ('style', 'visualize')]
+    elif kind == 'export':
+        params += [('doc', doc), ('format', 'ndjson')]
+    return '%s/explore?%s' % (explorer, urllib.urlencode(params))
+
+def parse_mix(mix):
+    """Parse e.g. "overview=1,visualize=3" into a weighted kind list."""
+    kinds = []
+    for part in mix.split(','):
+        try:
+            kind, weight = part.split('=')
+            weight = int(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError('expected KIND=WEIGHT, got '
+                                             '"%s"' % part)
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError('unknown request kind "%s" '
+                                             '(choose from %s)' % (
+                                                 kind, ', '.join(KINDS)))
+        kinds.extend([kind] * weight)
+    if not kinds:
+        raise argparse.ArgumentTypeError('no requests in mix')
+    return kinds
+
+def is_success(response):
+    """Return True if response is a successful explorer response."""
+    if response.status_code != 200:
+        return False
+    if 'html' in response.headers.get('Content-Type', ''):
+        return ERROR_PAGE_MARKER not in response.text
+    return True
+
+def process_tree(pid):
+    """Return pid and the pids of its descendants (Linux only)."""
+    children = defaultdict(list)
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+        children[ppid].append(int(name))
+    pids, stack = [], [pid]
+    while stack:
+        p = stack.pop()
+        pids.append(p)
+        stack.extend(children[p])
+    return pids
+
+def rss_kb(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+class MemorySampler(threading.Thread):
+    """Tracks peak total and per-process RSS of a process tree."""
+
+    def __init__(self, pid, interval=0.5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid
+        self.interval = interval
+        self.peak_total = 0
+        self.peak_process = 0
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            sizes = [rss_kb(p) for p in process_tree(self.pid)]
+            self.peak_total = max(self.peak_total, sum(sizes))
+            self.peak_process = max([self.peak_process] + sizes)
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values)-1, int(p / 100. * len(values)))]
+
+def run_load(explorer, store_base, kinds, documents, concurrency, total):
+    """Issue total requests from concurrency threads, returning dict of
+    latencies and dict of error counts by kind, and elapsed time."""
+    latencies, errors = defaultdict(list), defaultdict(int)
+    lock = threading.Lock()
+    remaining = [total]
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            kind = random.choice(kinds)
+            url = request_urls(explorer, store_base, kind, documents)
+            started = time.time()
+            try:
+                response = session.get(url)
+                ok = is_success(response)
+            except requests.RequestException:
+                ok = False
+            elapsed = time.time() - started
+            with lock:
+                if ok:
+                    latencies[kind].append(elapsed)
+                else:
+                    errors[kind] += 1
+
+    threads = [threading.Thread(target=client) for i in range(concurrency)]
+    started = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors, time.time() - started
+
+def report(latencies, errors, elapsed, memory=None):
+    completed = sum(len(v) for v in latencies.values())
+    print 'requests: %d ok, %d failed in %.1fs: %.1f requests/s' % (
+        completed, sum(errors.values()), elapsed, completed / elapsed)
+    print '%-10s %6s %6s %8s %8s %8s %8s' % ('kind', 'ok', 'failed',
+                                            'p50 ms', 'p90 ms', 'p99 ms',
+                                            'max ms')
+    for kind in sorted(set(latencies) | set(errors)):
+        values = latencies[kind]
+        print '%-10s %6d %6d %8.1f %8.1f %8.1f %8.1f' % (
+            kind, len(values), errors[kind],
+            1000*percentile(values, 50), 1000*percentile(values, 90),
+            1000*percentile(values, 99), 1000*max(values or [float('nan')]))
+    if memory is not None:
+        print 'explorer memory: peak %.1f MB total, %.1f MB per process' % (
+            memory.peak_total / 1024., memory.peak_process / 1024.)
+
+def argparser():
+    ap = argparse.ArgumentParser(description='Load test oaexplorer')
+    ap.add_argument('-e', '--explorer', default='http://127.0.0.1:7000',
+                    help='explorer base URL')
+    ap.add_argument('--start', default=False, action='store_true',
+                    help='start explorer (oaexplorer.py -p PORT) for the test')
+    ap.add_argument('--production', default=False, action='store_true',
+                    help='start explorer in production mode')
+    ap.add_argument('--pid', type=int, default=None,
+                    help='track memory of explorer running as PID')
+    ap.add_argument('-c', '--concurrency', type=int, default=8)
+    ap.add_argument('-n', '--requests', type=int, default=500)
+    ap.add_argument('--mix', type=parse_mix,
+                    default='overview=1,list=1,visualize=2',
+                    help='request kinds (overview, list, visualize, '
+                    'export) with weights')
+    ap.add_argument('--store-port', type=int, default=0,
+                    help='stub store port (default any free port)')
+    ap.add_argument('--documents', type=int, default=100)
+    ap.add_argument('--annotations', type=int, default=50,
+                    help='annotations per document')
+    ap.add_argument('--text-length', type=int, default=5000,
+                    help='characters per document')
+    ap.add_argument('--page-size', type=int, default=None,
+                    help='annotations per collection page (default all)')
+    ap.add_argument('--latency', type=float, default=0,
+                    help='stub server latency in seconds')
+    ap.add_argument('--no-etags', default=False, action='store_true',
+                    help='don\'t send ETags from the stub server')
+    ap.add_argument('--no-charset', default=False, action='store_true',
+                    help='omit charset from document Content-Type')
+    return ap
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    store = StubStore(args.documents, args.annotations, args.text_length)
+    server = start_stub_server(store, args.store_port, args.latency,
+                               args.page_size, not args.no_etags,
+                               args.no_charset)
+    print 'stub store at %s/annotations' % server.base
+
+    process, pid = None, args.pid
+    if args.start:
+        port = urlparse.urlparse(args.explorer).port or 80
+        command = [sys.executable, EXPLORER, '-p', str(port)]
+        if args.production:
+            command.append('--production')
+        process = subprocess.Popen(command)
+        pid = process.pid
+        # wait for explorer to accept connections
+        for i in range(100):
+            try:
+                requests.get(args.explorer + '/explore')
+                break
+            except requests.RequestException:
+                time.sleep(0.1)
+
+    memory = None
+    if pid is not None and os.path.isdir('/proc'):
+        memory = MemorySampler(pid)
+        memory.start()
+    try:
+        latencies, errors, elapsed = run_load(
+            args.explorer, server.base, args.mix,
+            args.documents, args.concurrency, args.requests)
+    finally:
+        if memory is not None:
+            memory.done.set()
+            memory.join()
+        if process is not None:
+            process.terminate()
+            process.wait()
+        server.shutdown()
+    report(latencies, errors, elapsed, memory)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
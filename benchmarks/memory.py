@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""Peak memory of explorer processing stages on reference inputs.
+
+Runs the collection and rendering stages of the explorer on synthetic
+reference inputs with memory accounting enabled (see StageMemory in
+profiling.py) and reports the peak memory used in each stage. With
+--save, the peaks are stored as a baseline; with --check, the run
+fails if any stage exceeds its baseline peak by more than the
+threshold. Baselines record the way memory was measured, and are
+only compared with runs measuring the same way.
+
+For example:
+
+    python benchmarks/memory.py --save memory-baseline.json
+    (make changes)
+    python benchmarks/memory.py --check memory-baseline.json
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from profiling import memory, memory_stage
+from compact import CompactAnnotations
+from docindex import DocumentIndex
+from so2html import standoff_to_html
+from oastore import jsonld, annotations_to_standoffs, iter_filtered
+
+from collection_memory import synthetic_annotations
+from html_size import synthetic_document
+
+BASE_URL = 'http://example.org/annotations/'
+
+def run_stages(annotation_count, span_count):
+    """Run processing stages on reference inputs of given sizes."""
+    data = json.dumps({ '@graph': synthetic_annotations(annotation_count) })
+    with memory_stage('collection.parse'):
+        document = json.loads(data)
+    del data
+    context = jsonld.document_context(document, BASE_URL)
+    items = document.pop('@graph')
+    with memory_stage('collection.expand'):
+        annotations = CompactAnnotations(
+            jsonld.expand_items(items, context, BASE_URL))
+    del items
+    with memory_stage('index'):
+        index = DocumentIndex(annotations)
+    doc = index.page(0, 1, 'count').documents[0].title
+    with memory_stage('standoffs'):
+        annotations_to_standoffs(
+            iter_filtered(index.annotations(doc, annotations), doc))
+    text, standoffs = synthetic_document(span_count)
+    with memory_stage('render'):
+        standoff_to_html(text, standoffs, legend=True, tooltips=True,
+                         links=True, compact=True)
+
+def regressions(peaks, baseline, threshold, slack):
+    """Return list of (stage, baseline, peak) for stages whose peak
+    exceeds baseline by more than the threshold fraction and slack
+    bytes."""
+    return [(stage, baseline[stage], peak)
+            for stage, peak in sorted(peaks.items())
+            if stage in baseline and
+            peak > baseline[stage] * (1 + threshold) + slack]
+
+def argparser():
+    ap = argparse.ArgumentParser(description='Measure peak memory of '
+                                 'processing stages')
+    ap.add_argument('-a', '--annotations', type=int, default=100000,
+                    help='annotations in reference collection')
+    ap.add_argument('-s', '--spans', type=int, default=20000,
+                    help='spans in reference document')
+    ap.add_argument('--save', metavar='FILE', default=None,
+                    help='save peaks as baseline')
+    ap.add_argument('--check', metavar='FILE', default=None,
+                    help='fail if peaks exceed baseline')
+    ap.add_argument('-t', '--threshold', type=float, default=0.1,
+                    help='allowed fraction over baseline (default 0.1)')
+    ap.add_argument('--slack', type=int, default=64*1024,
+                    help='allowed bytes over baseline (default 64K)')
+    return ap
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    try:
+        memory.enable()
+    except RuntimeError, e:
+        print >> sys.stderr, 'Error: %s' % str(e)
+        return 2
+    method = memory.meter.name
+    memory.start_request()
+    run_stages(args.annotations, args.spans)
+    peaks = memory.finish_request('reference')
+    print 'measured with %s' % method
+    for stage, peak in peaks.items():
+        print '%-20s %12d bytes' % (stage, peak)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'annotations': args.annotations,
+                'spans': args.spans,
+                'method': method,
+                'peaks': peaks,
+            }, f, indent=2)
+    if args.check:
+        with open(args.check) as f:
+            baseline = json.load(f)
+        if (baseline['annotations'], baseline['spans']) != (args.annotations,
+                                                           args.spans):
+            print >> sys.stderr, 'Error: baseline is for different inputs'
+            return 2
+        if baseline.get('method') != method:
+            print >> sys.stderr, 'Error: baseline measured with %s, not %s' % (
+                baseline.get('method'), method)
+            return 2
+        failed = regressions(peaks, baseline['peaks'], args.threshold,
+                             args.slack)
+        for stage, expected, peak in failed:
+            print >> sys.stderr, 'REGRESSION %s: %d bytes, baseline %d' % (
+                stage, peak, expected)
+        if failed:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
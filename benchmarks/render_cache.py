@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""Check and time so2html partition caching.
+
+Renders a synthetic document with sparse annotations, so that it
+splits into many partitions, without a cache, with a cold and a warm
+cache and in a process pool, checking that all renderings are
+identical, in both full and compact mode. Then adds an annotation of
+a new type and reports how many partitions are rendered again.
+
+Exits with status 1 if any rendering differs.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from so2html import standoff_to_html
+
+from html_size import Standoff, TYPE_PREFIXES, tag_structure
+
+class DictCache(dict):
+    """Cache with the get() and set() of LRUCache, without a bound."""
+    def set(self, key, value):
+        self[key] = value
+
+def sparse_document(length, seed=0):
+    """Return text of given length and standoffs about every 100
+    characters. The text includes a NUL character."""
+    r = random.Random(seed)
+    text = u''.join(r.choice(u'abcde \n') for i in range(length))
+    text = text[:length//2] + u'\x00' + text[length//2+1:]
+    standoffs = []
+    for start in range(0, length - 300, r.randrange(50, 150)):
+        type_ = r.choice(TYPE_PREFIXES) + '%07d' % r.randrange(40)
+        standoffs.append(Standoff(start, start + r.randrange(3, 300), type_))
+    return text, standoffs
+
+def render(text, standoffs, compact, **options):
+    started = time.time()
+    html = standoff_to_html(text, standoffs, legend=True, tooltips=True,
+                            links=True, compact=compact, **options)
+    return html, time.time() - started
+
+def check(text, standoffs, compact):
+    """Return list of descriptions of renderings that differ from the
+    uncached one."""
+    name = 'compact' if compact else 'full'
+    failed = []
+    expected, elapsed = render(text, standoffs, compact)
+    print '%-8s uncached     %6.3fs' % (name, elapsed)
+    cache = DictCache()
+    for label, options in (('cold', { 'cache': cache }),
+                           ('warm', { 'cache': cache }),
+                           ('pooled', { 'processes': 2 }),
+                           ('pooled+cache', { 'processes': 2,
+                                              'cache': DictCache() })):
+        html, elapsed = render(text, standoffs, compact, **options)
+        print '%-8s %-12s %6.3fs' % (name, label, elapsed)
+        if html != expected:
+            failed.append('%s %s' % (name, label))
+    partitions = len(cache)
+    added = [Standoff(len(text) - 200, len(text) - 190,
+                      'http://example.org/new-type')]
+    expected, _ = render(text, standoffs + added, compact)
+    html, elapsed = render(text, standoffs + added, compact, cache=cache)
+    print '%-8s new type     %6.3fs, %d of %d partitions rendered' % (
+        name, elapsed, len(cache) - partitions, partitions)
+    if html != expected:
+        failed.append('%s new type' % name)
+    return failed
+
+def main(argv):
+    length = int(argv[1]) if len(argv) > 1 else 100000
+    text, standoffs = sparse_document(length)
+    failed = check(text, standoffs, False) + check(text, standoffs, True)
+    # Text and tag structure should not depend on the mode.
+    pages = [render(text, standoffs, c)[0] for c in (False, True)]
+    if tag_structure(pages[0]) != tag_structure(pages[1]):
+        failed.append('full and compact structure')
+    for f in failed:
+        print >> sys.stderr, 'MISMATCH: %s' % f
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""Calibrate the rendering time estimates of so2html.
+
+Times the rendering of synthetic documents of varying size, span
+length (and so overlap) and line count, and fits the constants
+SECONDS_PER_SPAN and SECONDS_PER_OVERLAP that predict_render_time()
+multiplies with the factors given by render_time_factors(). The fit
+minimizes relative error. Reports the fitted constants and, for each
+document, the measured time and the times predicted with the fitted
+and the current constants.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import so2html
+
+from so2html import standoff_to_html, collapse_standoffs
+from so2html import render_time_factors
+
+from html_size import Standoff, TYPE_PREFIXES
+
+# (spans, maximum span length, characters per line) of the documents.
+CASES = [(spans, length, line)
+         for spans in (1000, 4000, 16000)
+         for length in (10, 50, 200)
+         for line in (80, 1000)]
+
+def synthetic_document(spans, max_length, line_length, seed=0):
+    """Return text and standoffs with spans starting about every 20
+    characters, and a newline about every line_length characters."""
+    r = random.Random(seed)
+    length = spans * 20 + max_length
+    text = u''.join(u'\n' if r.randrange(line_length) == 0 else
+                    r.choice(u'abcde ') for i in range(length))
+    standoffs = []
+    for i in range(spans):
+        start = r.randrange(length - max_length)
+        type_ = r.choice(TYPE_PREFIXES) + '%07d' % r.randrange(100)
+        standoffs.append(Standoff(start, start + r.randrange(1, max_length+1),
+                                  type_))
+    return text, standoffs
+
+def render_time(text, standoffs, repeats):
+    """Return shortest time of rendering as the explorer does."""
+    best = None
+    for i in range(repeats):
+        started = time.time()
+        standoff_to_html(text, standoffs, legend=True, tooltips=True,
+                         links=True, compact=True)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def fit(samples):
+    """Return (per span, per overlap) minimizing the sum of squared
+    relative errors for (spans, overlaps, seconds) samples."""
+    # Normal equations of least squares for rows (s/t, o/t) with
+    # target 1.
+    ss = so = oo = s1 = o1 = 0.
+    for spans, overlaps, seconds in samples:
+        s, o = spans / seconds, overlaps / seconds
+        ss, so, oo = ss + s*s, so + s*o, oo + o*o
+        s1, o1 = s1 + s, o1 + o
+    det = ss * oo - so * so
+    return (s1 * oo - o1 * so) / det, (o1 * ss - s1 * so) / det
+
+def argparser():
+    ap = argparse.ArgumentParser(description='Calibrate rendering time '
+                                 'estimates')
+    ap.add_argument('-r', '--repeats', type=int, default=3,
+                    help='renderings per document (default 3)')
+    return ap
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    samples = []
+    for spans, length, line in CASES:
+        text, standoffs = synthetic_document(spans, length, line)
+        collapsed = collapse_standoffs(standoffs)
+        factors = render_time_factors(text, collapsed)
+        seconds = render_time(text, standoffs, args.repeats)
+        samples.append(factors + (seconds,))
+    per_span, per_overlap = fit(samples)
+    current = (so2html.SECONDS_PER_SPAN, so2html.SECONDS_PER_OVERLAP)
+    print '%6s %6s %5s %8s %12s %9s %9s %9s' % (
+        'spans', 'length', 'line', 'factor', 'overlaps', 'measured',
+        'fitted', 'current')
+    for (spans, length, line), (s, o, seconds) in zip(CASES, samples):
+        print '%6d %6d %5d %8d %12d %8.3fs %8.3fs %8.3fs' % (
+            spans, length, line, s, o, seconds,
+            s * per_span + o * per_overlap,
+            s * current[0] + o * current[1])
+    print 'SECONDS_PER_SPAN = %.3g (current %.3g)' % (per_span, current[0])
+    print 'SECONDS_PER_OVERLAP = %.3g (current %.3g)' % (per_overlap,
+                                                        current[1])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
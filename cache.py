@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""Simple in-memory caches for the RESTful Open Annotation explorer."""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import time
+import threading
+
+from collections import OrderedDict
+
+class LRUCache(object):
+    """Thread-safe mapping with least-recently-used eviction.
+
+    Holds at most maxsize items. If ttl is not None, items older than
+    ttl seconds are treated as missing.
+    """
+
+    def __init__(self, maxsize=100, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, stored = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl is not None and time.time() - stored > self.ttl:
+                self.misses += 1
+                return default
+            # re-insert to mark as most recently used
+            self._items[key] = (value, stored)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, time.time())
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                return self._items.pop(key)[0]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def items(self):
+        """Return list of (key, value) pairs, least recently used
+        first. Includes items older than ttl."""
+        with self._lock:
+            return [(k, v) for k, (v, stored) in self._items.items()]
+
+    def stats(self):
+        """Return dict with size and hit and miss counts."""
+        return { 'size': len(self), 'hits': self.hits, 'misses': self.misses }
+
+    def __contains__(self, key):
+        # Unlike get(), doesn't count or mark as recently used.
+        with self._lock:
+            item = self._items.get(key)
+            return item is not None and (self.ttl is None or
+                                         time.time() - item[1] <= self.ttl)
+
+    def __len__(self):
+        return len(self._items)
+
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""Compact in-memory representation of annotation lists.
+
+Annotations parsed from JSON repeat the same keys, target document
+URLs, types and bodies as separate objects in separate dicts.
+CompactAnnotations stores each distinct string and each distinct
+non-string value once, in tables, and the annotations as runs of
+integer ids in a single array. Annotations are reconstructed as dicts
+on access.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import json
+
+from array import array
+
+# Tags in the two low bits of encoded values: index into the string
+# table, index into the object table (non-string values), or index of
+# the part of a string before "#", followed by the index of the part
+# after it (e.g. "http://example.org/doc#char=0,5").
+STRING, OBJECT, SPLIT = 0, 1, 2
+
+class CompactAnnotations(object):
+    """Read-only sequence of annotations stored compactly.
+
+    Items are reconstructed as new dicts on each access. Values other
+    than strings are shared between items and must not be modified.
+    """
+
+    def __init__(self, annotations):
+        self._strings, self._objects, self._shapes = [], [], []
+        string_ids, object_ids, shape_ids = {}, {}, {}
+
+        def intern_string(s):
+            i = string_ids.get(s)
+            if i is None:
+                i = string_ids[s] = len(self._strings)
+                self._strings.append(s)
+            return i
+
+        # Per annotation, index into _shapes (tuples of keys) and start
+        # position in _values.
+        self._shape = array('I')
+        self._start = array('L')
+        self._values = values = array('l')
+        for annotation in annotations:
+            keys = tuple(annotation)
+            shape = shape_ids.get(keys)
+            if shape is None:
+                shape = shape_ids[keys] = len(self._shapes)
+                self._shapes.append(keys)
+            self._shape.append(shape)
+            self._start.append(len(values))
+            for key in keys:
+                value = annotation[key]
+                if isinstance(value, basestring):
+                    if '#' in value:
+                        base, fragment = value.split('#', 1)
+                        values.append(intern_string(base) << 2 | SPLIT)
+                        values.append(intern_string(fragment))
+                    else:
+                        values.append(intern_string(value) << 2 | STRING)
+                else:
+                    canonical = json.dumps(value, sort_keys=True)
+                    i = object_ids.get(canonical)
+                    if i is None:
+                        i = object_ids[canonical] = len(self._objects)
+                        self._objects.append(value)
+                    values.append(i << 2 | OBJECT)
+
+    def _decode(self, position):
+        """Return value encoded at position and position of next."""
+        encoded = self._values[position]
+        tag, i = encoded & 3, encoded >> 2
+        if tag == STRING:
+            return self._strings[i], position+1
+        elif tag == OBJECT:
+            return self._objects[i], position+1
+        else:
+            fragment = self._strings[self._values[position+1]]
+            return self._strings[i] + '#' + fragment, position+2
+
+    def __len__(self):
+        return len(self._shape)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        position, annotation = self._start[index], {}
+        for key in self._shapes[self._shape[index]]:
+            annotation[key], position = self._decode(position)
+        return annotation
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def values_of(self, key):
+        """Generate value of key for each annotation, without
+        reconstructing the annotations. Raises KeyError if missing."""
+        for i in xrange(len(self)):
+            position = self._start[i]
+            for k in self._shapes[self._shape[i]]:
+                if k == key:
+                    yield self._decode(position)[0]
+                    break
+                position += 2 if self._values[position] & 3 == SPLIT else 1
+            else:
+                raise KeyError(key)
+
+def values_of(annotations, key):
+    """Generate value of key for each of given annotations, reading
+    CompactAnnotations (or other sequences with a values_of() method)
+    without reconstructing them."""
+    if hasattr(annotations, 'values_of'):
+        return annotations.values_of(key)
+    else:
+        return (a[key] for a in annotations)
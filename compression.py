@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""HTTP content compression for the RESTful Open Annotation explorer.
+
+Supports gzip and, if the brotli module is installed, brotli. Byte
+counts before and after compression are recorded by direction and
+encoding to tell how much transfer compression saves.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import zlib
+import threading
+
+from collections import defaultdict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Compression levels, chosen for speed as pages are compressed when
+# served or cached.
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Responses smaller than this (in bytes) are not worth compressing.
+MIN_SIZE = 1024
+
+# Streamed responses are flushed after this many uncompressed bytes.
+STREAM_FLUSH_BYTES = 16 * 1024
+
+# MIME types worth compressing in addition to text/*.
+COMPRESSIBLE_TYPES = set([
+    'application/json',
+    'application/ld+json',
+    'application/x-ndjson',
+    'application/javascript',
+])
+
+# Supported encodings in order of preference.
+ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+# Value of Accept-Encoding for upstream requests. These are decoded by
+# all versions of requests.
+ACCEPT_ENCODING = 'gzip, deflate'
+
+def compressible(mimetype):
+    return (mimetype is not None and
+            (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES))
+
+def negotiate(accept_encoding, offered=ENCODINGS):
+    """Return the first of the offered encodings acceptable by the
+    given Accept-Encoding header value, or None if none is."""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        coding, q = parts[0].strip().lower(), 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    for encoding in offered:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+def _gzip_compressobj():
+    # wbits of 16+MAX_WBITS selects the gzip format.
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+
+def compress(data, encoding):
+    """Return data compressed with given encoding."""
+    if encoding == 'gzip':
+        c = _gzip_compressobj()
+        return c.compress(data) + c.flush()
+    elif encoding == 'br' and brotli is not None:
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    else:
+        raise ValueError('unsupported encoding %s' % encoding)
+
+def decompress(data, encoding):
+    """Return data compressed with given encoding decompressed."""
+    if encoding == 'gzip':
+        return zlib.decompress(data, 16+zlib.MAX_WBITS)
+    elif encoding == 'br' and brotli is not None:
+        return brotli.decompress(data)
+    else:
+        raise ValueError('unsupported encoding %s' % encoding)
+
+def compress_variants(data):
+    """Return dict mapping each supported encoding to data compressed
+    with it, for serving without compressing again."""
+    return { e: compress(data, e) for e in ENCODINGS }
+
+def compress_stream(chunks, encoding='gzip'):
+    """Generate gzip-compressed data from an iterable of strings,
+    recording byte counts when done."""
+    if encoding != 'gzip':
+        raise ValueError('unsupported stream encoding %s' % encoding)
+    c = _gzip_compressobj()
+    size_in, size_out, unflushed = 0, 0, 0
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        size_in += len(chunk)
+        unflushed += len(chunk)
+        compressed = c.compress(chunk)
+        if unflushed >= STREAM_FLUSH_BYTES:
+            # Flush so that clients see streamed content without
+            # waiting for the compressor to fill its buffers.
+            compressed += c.flush(zlib.Z_SYNC_FLUSH)
+            unflushed = 0
+        if compressed:
+            size_out += len(compressed)
+            yield compressed
+    compressed = c.flush()
+    size_out += len(compressed)
+    yield compressed
+    byte_counts.record('downstream', encoding, size_in, size_out)
+
+class ByteCounts(object):
+    """Counts of bytes before and after compression by direction and
+    encoding."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(lambda: defaultdict(int))
+
+    def record(self, direction, encoding, uncompressed, compressed):
+        with self._lock:
+            counts = self._counts['%s/%s' % (direction, encoding)]
+            counts['count'] += 1
+            counts['uncompressed'] += uncompressed
+            counts['compressed'] += compressed
+
+    def stats(self):
+        """Return dict of counts with bytes saved."""
+        with self._lock:
+            stats = {}
+            for key, counts in self._counts.items():
+                stats[key] = dict(counts)
+                stats[key]['saved'] = (counts['uncompressed'] -
+                                       counts['compressed'])
+            return stats
+
+byte_counts = ByteCounts()
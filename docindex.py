@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""Per-collection document index for the RESTful Open Annotation explorer.
+
+The index groups the annotations of a collection by target document
+once so that document overviews can be paged, sorted and searched
+without regrouping the full collection for every request.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import urlparse
+
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from collections import defaultdict
+from itertools import chain
+
+from compact import values_of
+
+# Sort orders supported by DocumentIndex.page()
+SORT_ORDERS = ('title', 'count')
+
+DocumentEntry = namedtuple('DocumentEntry', 'title count positions')
+
+Page = namedtuple('Page', 'documents total start size')
+
+class DocumentIndex(object):
+    """Index of the target documents of a list of OA annotations."""
+
+    def __init__(self, annotations, target_key='target'):
+        positions = defaultdict(list)
+        for i, targets in enumerate(values_of(annotations, target_key)):
+            if isinstance(targets, basestring):
+                targets = [targets]
+            for target in targets:
+                document = urlparse.urldefrag(target)[0]
+                positions[document].append(i)
+        self.annotation_count = len(annotations)
+        self._entries = {
+            d: DocumentEntry(d, len(p), p) for d, p in positions.iteritems()
+        }
+        # Precomputed orders: titles ascending (also used for prefix
+        # search by bisection) and annotation counts descending.
+        self._by_title = sorted(self._entries)
+        self._by_count = sorted(self._by_title,
+                                key=lambda d: -self._entries[d].count)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, document):
+        return document in self._entries
+
+    def get(self, document):
+        """Return DocumentEntry for given document, or None if not found."""
+        return self._entries.get(document)
+
+    def annotations(self, document, annotations):
+        """Return the subset of annotations that target given document.
+
+        The annotations must be the list that the index was built from.
+        """
+        entry = self._entries.get(document)
+        if entry is None:
+            return []
+        return [annotations[i] for i in entry.positions]
+
+    def _matching(self, prefix):
+        """Return titles starting with prefix in title order."""
+        if not prefix:
+            return self._by_title
+        if isinstance(prefix, str):
+            prefix = prefix.decode('utf-8')
+        # All strings starting with prefix sort before its successor,
+        # formed by incrementing the last character.
+        successor = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+        start = bisect_left(self._by_title, prefix)
+        end = bisect_left(self._by_title, successor, start)
+        return self._by_title[start:end]
+
+    def page(self, start=0, size=50, sort='title', prefix=None):
+        """Return Page of DocumentEntry values in the given sort order,
+        starting from start and including at most size items.
+
+        If prefix is given, include only documents whose URL starts
+        with it.
+        """
+        if sort not in SORT_ORDERS:
+            raise ValueError('unknown sort order %s' % sort)
+        if prefix:
+            titles = self._matching(prefix)
+            if sort == 'count':
+                titles = sorted(titles, key=lambda d: -self._entries[d].count)
+        elif sort == 'count':
+            titles = self._by_count
+        else:
+            titles = self._by_title
+        start = max(0, start)
+        selected = titles[start:start+size]
+        return Page([self._entries[d] for d in selected], len(titles),
+                    start, size)
+
+class FederatedIndex(DocumentIndex):
+    """Shared index of the target documents of annotations from several
+    sources (e.g. collections from different stores).
+
+    Documents are identified by target URL without fragment, so
+    annotations of the same document from different sources are
+    grouped together.
+    """
+
+    def __init__(self, annotation_lists, target_key='target'):
+        self.annotation_lists = annotation_lists
+        self.merged = _Concatenation(annotation_lists)
+        DocumentIndex.__init__(self, self.merged, target_key)
+        self._offsets = self.merged.offsets
+
+    def source(self, position):
+        """Return index of the source of annotation at given position."""
+        return self.merged.source(position)
+
+    def sources(self, document):
+        """Return (source index, annotation) pairs for annotations
+        targeting given document."""
+        entry = self.get(document)
+        if entry is None:
+            return []
+        return [(self.source(i), self.merged[i]) for i in entry.positions]
+
+    def source_counts(self, document):
+        """Return list of numbers of annotations targeting given
+        document by source."""
+        counts = [0] * len(self._offsets)
+        entry = self.get(document)
+        if entry is not None:
+            for i in entry.positions:
+                counts[self.source(i)] += 1
+        return counts
+
+class _Concatenation(object):
+    """Read-only view of several sequences as one."""
+
+    def __init__(self, sequences):
+        self.sequences = sequences
+        # Position of the first item of each sequence.
+        self.offsets, offset = [], 0
+        for sequence in sequences:
+            self.offsets.append(offset)
+            offset += len(sequence)
+        self._length = offset
+
+    def source(self, position):
+        """Return index of the sequence with item at given position."""
+        return bisect_right(self.offsets, position) - 1
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, position):
+        i = self.source(position)
+        return self.sequences[i][position-self.offsets[i]]
+
+    def __iter__(self):
+        return chain.from_iterable(self.sequences)
+
+    def values_of(self, key):
+        return chain.from_iterable(values_of(s, key) for s in self.sequences)
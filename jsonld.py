@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+
+"""JSON-LD processing for the RESTful Open Annotation explorer.
+
+Implements the parts of JSON-LD 1.0 expansion that the explorer needs
+to read store responses: term definitions, compact IRIs, @vocab,
+@base, relative IRI resolution, keyword aliases and @id/@vocab type
+coercion. Instead of the fully expanded form, nodes are returned with
+their IRI values expanded and the keys of selected properties
+normalized to given names, so that annotations keep a compact shape
+that the rest of the explorer can read.
+
+Contexts are compiled once into term maps and the compiled contexts
+cached, and remote contexts are cached in memory and on disk, so that
+processing a document costs little more than one pass over its nodes.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import urlparse
+
+from collections import namedtuple
+
+from cache import LRUCache
+
+KEYWORDS = set([
+    '@context', '@id', '@value', '@language', '@type', '@container',
+    '@list', '@set', '@reverse', '@index', '@base', '@vocab', '@graph',
+])
+
+# IRI mapping and type coercion ('@id', '@vocab', a datatype IRI or
+# None) of a term.
+Term = namedtuple('Term', 'iri type')
+
+class ContextError(Exception):
+    """Raised for invalid or unavailable contexts."""
+    pass
+
+class ActiveContext(object):
+    """Compiled JSON-LD context.
+
+    Contexts are shared and must not be modified; extend() returns a
+    new context with additional definitions. Key expansions are
+    memoized per context.
+    """
+
+    def __init__(self, terms=None, base=None, vocab=None, names=None,
+                 key=()):
+        self.terms = dict(terms or {})
+        self.base = base
+        self.vocab = vocab
+        self.names = names or {}
+        self.key = key
+        self._keys = {}
+        self._coercions = None
+
+    def expand_iri(self, value, vocab=False, base=None, relative=True):
+        """Return IRI for string value.
+
+        If vocab is True, terms and @vocab apply. If relative is True,
+        relative IRIs are resolved against @base, or base if the
+        context doesn't set one.
+        """
+        if value[:1] == '@':
+            return value
+        if vocab:
+            term = self.terms.get(value)
+            if term is not None:
+                return term.iri if term.iri is not None else value
+        prefix, colon, suffix = value.partition(':')
+        if colon:
+            if prefix == '_' or suffix[:2] == '//':
+                return value # blank node or absolute IRI
+            term = self.terms.get(prefix)
+            if term is not None and term.iri is not None:
+                return term.iri + suffix
+            return value # absolute IRI
+        if vocab and self.vocab is not None:
+            return self.vocab + value
+        if relative:
+            base = self.base if self.base is not None else base
+            if base is not None:
+                return urlparse.urljoin(base, value)
+        return value
+
+    def key_name(self, key):
+        """Return (name, type coercion) for key: the keyword the key
+        is an alias for, the name given for its IRI, or the key
+        itself.
+
+        Keys that aren't terms, such as absolute or compact IRIs,
+        take the coercion of a term for the same IRI.
+        """
+        entry = self._keys.get(key)
+        if entry is None:
+            iri = self.expand_iri(key, vocab=True, relative=False)
+            if iri in KEYWORDS:
+                name = iri
+            else:
+                name = self.names.get(iri, key)
+            term = self.terms.get(key)
+            if term is not None:
+                coercion = term.type
+            else:
+                coercion = self._iri_coercions().get(iri)
+            entry = (name, coercion)
+            self._keys[key] = entry
+        return entry
+
+    def _iri_coercions(self):
+        # Type coercions of terms by IRI, for terms that have one.
+        if self._coercions is None:
+            self._coercions = {}
+            for term in sorted(self.terms):
+                iri, type_ = self.terms[term]
+                if iri is not None and type_ is not None:
+                    self._coercions.setdefault(iri, type_)
+        return self._coercions
+
+    def find_key(self, node, name):
+        """Return key in node with given name (see key_name()), or
+        None if there is none."""
+        for key in node:
+            if self.key_name(key)[0] == name:
+                return key
+        return None
+
+    def extend(self, definitions, key, base=None):
+        """Return new context with definitions from local context dict.
+
+        Relative @base values are resolved against base.
+        """
+        context = ActiveContext(self.terms, self.base, self.vocab,
+                                self.names, key)
+        if '@base' in definitions:
+            value = definitions['@base']
+            if value is not None and base is not None:
+                value = urlparse.urljoin(base, value)
+            context.base = value
+        if '@vocab' in definitions:
+            value = definitions['@vocab']
+            if value is not None:
+                value = context.expand_iri(value, vocab=True, base=base)
+            context.vocab = value
+        defined = {}
+        for term in definitions:
+            if term not in ('@base', '@vocab', '@language'):
+                context._define(term, definitions, defined)
+        return context
+
+    def _define(self, term, definitions, defined):
+        if defined.get(term):
+            return
+        elif term in defined:
+            raise ContextError('cyclic IRI mapping for %s' % term)
+        elif term in KEYWORDS:
+            raise ContextError('keyword redefinition: %s' % term)
+        defined[term] = False
+        value = definitions[term]
+        if value is None:
+            value = { '@id': None }
+        elif isinstance(value, basestring):
+            value = { '@id': value }
+        elif not isinstance(value, dict):
+            raise ContextError('invalid definition for %s' % term)
+        type_ = value.get('@type')
+        if type_ is not None and type_ not in ('@id', '@vocab'):
+            type_ = self._expand_defining(type_, definitions, defined)
+        if '@reverse' in value:
+            # Reverse properties aren't supported; leave undefined.
+            iri = None
+        elif '@id' in value:
+            iri = value['@id']
+            if iri is not None:
+                if not isinstance(iri, basestring):
+                    raise ContextError('invalid IRI mapping for %s' % term)
+                iri = self._expand_defining(iri, definitions, defined)
+        elif ':' in term:
+            iri = self._expand_defining(term, definitions, defined)
+        elif self.vocab is not None:
+            iri = self.vocab + term
+        else:
+            raise ContextError('no IRI mapping for %s' % term)
+        self.terms[term] = Term(iri, type_)
+        defined[term] = True
+
+    def _expand_defining(self, value, definitions, defined):
+        # Define terms that the value refers to first.
+        if value in definitions and value not in defined:
+            self._define(value, definitions, defined)
+        prefix, colon, suffix = value.partition(':')
+        if (colon and prefix in definitions and suffix[:2] != '//' and
+            not defined.get(prefix)):
+            self._define(prefix, definitions, defined)
+        return self.expand_iri(value, vocab=True, relative=False)
+
+class ContextLoader(object):
+    """Loader of remote contexts, caching them in memory and in
+    directory (if not None) for max_age seconds.
+
+    fetch is called with a URL and returns the parsed JSON document.
+    If fetching fails, an expired copy is used if available.
+    """
+
+    def __init__(self, fetch, directory=None, max_age=24*3600, maxsize=100):
+        self.fetch = fetch
+        self.directory = directory
+        self.max_age = max_age
+        self._memory = LRUCache(maxsize, ttl=max_age)
+        self.fetched = 0
+        self.disk_hits = 0
+        self.errors = 0
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def load(self, url):
+        """Return @context value of the JSON-LD document at url."""
+        context = self._memory.get(url)
+        if context is None:
+            context = self._load(url)
+            self._memory.set(url, context)
+        return context
+
+    def _path(self, url):
+        return os.path.join(self.directory,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest() + '.jsonld')
+
+    def _load(self, url):
+        stored, stored_time = None, None
+        if self.directory is not None:
+            path = self._path(url)
+            try:
+                with open(path) as f:
+                    stored = json.load(f)
+                stored_time = os.path.getmtime(path)
+            except (IOError, OSError, ValueError):
+                stored = None
+        if stored is not None and time.time() - stored_time < self.max_age:
+            self.disk_hits += 1
+            return stored
+        try:
+            document = self.fetch(url)
+            self.fetched += 1
+            if not isinstance(document, dict) or '@context' not in document:
+                raise ContextError('no @context in %s' % url)
+        except Exception, e:
+            self.errors += 1
+            if stored is None:
+                if isinstance(e, ContextError):
+                    raise
+                raise ContextError('failed to load %s: %s' % (url, str(e)))
+            logging.getLogger(__name__).warning(
+                'using expired context %s: %s' % (url, str(e)))
+            return stored
+        context = document['@context']
+        if self.directory is not None:
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(context, f)
+            os.rename(tmp, self._path(url))
+        return context
+
+    def stats(self):
+        return {
+            'memory': self._memory.stats(),
+            'disk_hits': self.disk_hits,
+            'fetched': self.fetched,
+            'errors': self.errors,
+        }
+
+class Processor(object):
+    """Expands JSON-LD documents, sharing compiled contexts.
+
+    Processing starts from the given default context, as with the
+    expandContext option of JSON-LD processors. names maps IRIs to the
+    keys used for them in processed nodes. Remote contexts are loaded
+    with loader; without one, they are errors.
+    """
+
+    def __init__(self, default_context=None, names=None, loader=None,
+                 maxsize=100):
+        self.loader = loader
+        self._compiled = LRUCache(maxsize)
+        self.initial = ActiveContext(names=names, key=('default',))
+        if default_context is not None:
+            self.initial = self.context(default_context, self.initial)
+
+    def context(self, local, parent=None, base=None):
+        """Return active context resulting from processing local
+        context (string, dict, None or list of these) on top of parent
+        (default initial). Relative context URLs are resolved against
+        base."""
+        if parent is None:
+            parent = self.initial
+        return self._process(local, parent, base, ())
+
+    def _process(self, local, parent, base, loading):
+        result = parent
+        for item in (local if isinstance(local, list) else [local]):
+            if item is None:
+                result = self.initial
+                continue
+            if isinstance(item, basestring):
+                url = urlparse.urljoin(base, item) if base else item
+                key = result.key + (url,)
+            elif isinstance(item, dict):
+                key = result.key + (json.dumps(item, sort_keys=True),)
+            else:
+                raise ContextError('invalid local context: %r' % item)
+            compiled = self._compiled.get(key)
+            if compiled is None:
+                if isinstance(item, dict):
+                    compiled = result.extend(item, key, base)
+                elif self.loader is None:
+                    raise ContextError('no loader for remote context %s' % url)
+                elif url in loading:
+                    raise ContextError('recursive context inclusion: %s' % url)
+                else:
+                    compiled = self._process(self.loader.load(url), result,
+                                             url, loading + (url,))
+                self._compiled.set(key, compiled)
+            result = compiled
+        return result
+
+    def document_context(self, document, base=None):
+        """Return active context for top-level node of document."""
+        if isinstance(document, dict) and '@context' in document:
+            return self.context(document['@context'], self.initial, base)
+        return self.initial
+
+    def expand(self, value, context=None, base=None, coercion=None):
+        """Return copy of value with IRIs expanded and keys named as
+        described in the class docstring. Relative IRIs are resolved
+        against base, which is normally the document URL."""
+        if context is None:
+            context = self.initial
+        if isinstance(value, dict):
+            if '@value' in value:
+                return value
+            if '@context' in value:
+                context = self.context(value['@context'], context, base)
+            expanded = {}
+            for key, v in value.iteritems():
+                name, type_ = context.key_name(key)
+                if name == '@id':
+                    if isinstance(v, basestring):
+                        v = context.expand_iri(v, base=base)
+                elif name == '@type':
+                    v = self._expand_types(v, context, base)
+                elif name != '@context':
+                    v = self.expand(v, context, base, type_)
+                expanded[name] = v
+            return expanded
+        elif isinstance(value, list):
+            return [self.expand(v, context, base, coercion) for v in value]
+        elif coercion in ('@id', '@vocab') and isinstance(value, basestring):
+            return context.expand_iri(value, vocab=(coercion == '@vocab'),
+                                      base=base)
+        else:
+            return value
+
+    def expand_items(self, items, context=None, base=None):
+        """Generate expanded items of list, releasing each original
+        from the list once expanded."""
+        for i in xrange(len(items)):
+            item, items[i] = items[i], None
+            yield self.expand(item, context, base)
+
+    def _expand_types(self, types, context, base):
+        if isinstance(types, basestring):
+            return context.expand_iri(types, vocab=True, base=base)
+        elif isinstance(types, list):
+            return [context.expand_iri(t, vocab=True, base=base)
+                    if isinstance(t, basestring) else t for t in types]
+        else:
+            return types
+
+    def types(self, node, context=None, base=None):
+        """Return list of expanded @type values of node."""
+        if context is None:
+            context = self.initial
+        key = context.find_key(node, '@type')
+        if key is None:
+            return []
+        types = self._expand_types(node[key], context, base)
+        return types if isinstance(types, list) else [types]
+
+    def stats(self):
+        stats = { 'compiled': self._compiled.stats() }
+        if self.loader is not None:
+            stats['remote'] = self.loader.stats()
+        return stats
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""Convert RESTful Open Annotation collections into span files.
+
+Writes the standoffs of each document targeted by annotations in a
+collection into a span file (see spanfile.py) named by the quoted
+document URL, optionally with the document text, for rendering with
+so2html.py, e.g.
+
+    python oa2spans.py -t -d out http://example.org/annotations
+    python so2html.py @out/DOC.txt @out/DOC.spans > DOC.html
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import os
+import sys
+import urllib
+import argparse
+import codecs
+
+from oastore import get_annotations, get_document_text, iter_filtered
+from oastore import annotations_to_standoffs
+from docindex import DocumentIndex
+from spanfile import write_spans
+
+def argparser():
+    ap = argparse.ArgumentParser(description='Convert OA collection to '
+                                 'span files')
+    ap.add_argument('-d', '--directory', default='.',
+                    help='output directory')
+    ap.add_argument('-t', '--texts', default=False, action='store_true',
+                    help='also write document texts')
+    ap.add_argument('collection', help='collection URL')
+    ap.add_argument('documents', nargs='*',
+                    help='documents to convert (default all)')
+    return ap
+
+def convert(annotations, index, doc, directory, texts=False):
+    base = os.path.join(directory, urllib.quote(doc, safe=''))
+    standoffs = annotations_to_standoffs(
+        iter_filtered(index.annotations(doc, annotations), doc))
+    write_spans(base + '.spans', standoffs)
+    if texts:
+        with codecs.open(base + '.txt', 'w', encoding='utf-8') as f:
+            f.write(get_document_text(doc))
+    return len(standoffs)
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    if not os.path.isdir(args.directory):
+        os.makedirs(args.directory)
+    annotations = get_annotations(args.collection)
+    index = DocumentIndex(annotations)
+    documents = args.documents
+    if not documents:
+        documents = [e.title for e in index.page(0, len(index)).documents]
+    for doc in documents:
+        if doc not in index:
+            print >> sys.stderr, 'No annotations for %s' % doc
+            continue
+        count = convert(annotations, index, doc, args.directory, args.texts)
+        print >> sys.stderr, 'Wrote %d standoffs for %s' % (count, doc)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -12,18 +12,46 @@ import sys
 import json
 import urlparse
 import urllib
-import cgi
+import os
+import time
+import tempfile
+import hmac
+import hashlib
+import argparse
+import zipfile
+import threading
+import multiprocessing
 
 import flask
-import requests
 
 from collections import namedtuple
 from collections import defaultdict
+from collections import OrderedDict
+from collections import deque
+from itertools import izip
 
 from webargs import Arg
 from webargs.flaskparser import use_args
 
-from so2html import standoff_to_html
+from so2html import standoff_to_html, standoff_to_client_html, start_pool
+from so2html import render_mode_counts, CollapsedStandoff, FULL
+from docindex import DocumentIndex, FederatedIndex, SORT_ORDERS
+from cache import LRUCache
+from admission import AdmissionController, Overloaded, estimate_cost
+from profiling import profile_call, SamplingProfiler, memory, memory_stage
+from prefetch import Prefetcher
+from compression import compress, decompress, compress_variants
+from compression import compress_stream, compressible, negotiate
+from compression import byte_counts, MIN_SIZE
+from snapshot import Snapshot, SnapshotWriter
+from upstream import UpstreamBusy
+import oastore
+from oastore import ITEMS_KEY, DEFAULT_PREFIXES, ALL_DOCUMENTS, Standoff
+from oastore import FormatError
+from oastore import collection_cache, collection_validators, text_cache
+from oastore import upstream, jsonld
+from oastore import get_collection, get_annotations, get_document_text
+from oastore import iter_filtered, annotations_to_standoffs
 
 try:
     from development import DEBUG
@@ -33,15 +61,100 @@ except ImportError:
 
 API_ROOT = '/explore'
 
-# Key for the list of collection items in RESTful OA collection
-# response.
-ITEMS_KEY = '@graph'
+# Default and maximum number of documents per document overview page.
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
 
-# JSON-LD @type values recognized as identifying an OA annotation.
-ANNOTATION_TYPES = [
-    'oa:Annotation',
-    'http://www.w3.org/ns/oa#Annotation',
-]
+# Machine-readable export formats and their MIME types.
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json',
+}
+
+# Values for the export parameter: what to include in exports.
+EXPORT_CONTENT = ('annotations', 'standoffs', 'both')
+
+# Number of template stream items to buffer before sending a chunk.
+TEMPLATE_STREAM_BUFFER = 20
+
+# Number of processes for rendering documents of at least
+# PARALLEL_RENDER_MIN_LENGTH characters in parallel.
+RENDER_PROCESSES = multiprocessing.cpu_count()
+PARALLEL_RENDER_MIN_LENGTH = 100000
+
+# Document indexes of recently explored collections, keyed by
+# collection URL. Entries expire so that changes in the store become
+# visible without a restart.
+document_indexes = LRUCache(maxsize=100, ttl=300)
+
+# Limits on concurrent visualization requests by estimated cost.
+admission = AdmissionController()
+
+# Time budget for rendering in seconds. Rendering is simplified for
+# documents predicted or found to exceed it.
+RENDER_BUDGET = 5
+
+# Limits and pools for batch rendering. Texts of batch documents are
+# fetched in BATCH_FETCH_THREADS threads and documents rendered in
+# RENDER_PROCESSES processes (BATCH_RENDER_THREADS threads when serving
+# with preforked workers), with at most BATCH_RENDER_AHEAD documents
+# waiting to be sent.
+MAX_BATCH_DOCUMENTS = 500
+BATCH_FORMATS = ('ndjson', 'zip')
+BATCH_FETCH_THREADS = 8
+BATCH_RENDER_THREADS = 2
+BATCH_RENDER_AHEAD = 16
+BATCH_RENDER_TIMEOUT = 60
+
+# Rendering options of visualizations, shared by single and batch
+# rendering so that batches can use pages in page_cache.
+RENDER_OPTIONS = { 'legend': True, 'tooltips': True, 'links': True }
+
+# Snapshot of in-memory caches for warm restarts, written every
+# SNAPSHOT_INTERVAL seconds when enabled (see start_snapshots()).
+# Snapshot files of processes that haven't written for
+# SNAPSHOT_MAX_AGE seconds are removed.
+SNAPSHOT_INTERVAL = 300
+SNAPSHOT_MAX_AGE = 3 * SNAPSHOT_INTERVAL
+snapshot = None
+_snapshot_restored = False
+_snapshot_lock = threading.Lock()
+
+# Document indexes from the snapshot with the annotations they index,
+# keyed by collection URL (see _saved_collection()).
+_saved_indexes = {}
+
+# Federated exploration: maximum number of stores per request, number
+# of threads fetching from stores and the default and maximum time in
+# seconds to wait for them. Stores that don't respond in time are
+# left out. MAX_FEDERATED_STORES must stay below
+# oastore.COLLECTION_CACHE_SIZE.
+MAX_FEDERATED_STORES = 10
+FEDERATION_THREADS = 16
+FEDERATED_TIMEOUT = 10
+
+# Secret required for profiling requests with profile=1. Profiling is
+# disabled if not set.
+PROFILE_TOKEN = os.environ.get('OAEXPLORER_PROFILE_TOKEN')
+
+# Code to include in stacks recorded by the sampling profiler.
+SAMPLED_FILES = ('so2html.py',)
+SAMPLED_FUNCTIONS = ('fetch', 'get_collection', 'get_document_text')
+
+# Rendered parts of documents, see so2html.standoff_to_html().
+render_cache = LRUCache(maxsize=2000)
+
+# Rendered visualization pages, stored compressed with each supported
+# encoding (see render_page()).
+page_cache = LRUCache(maxsize=200)
+
+# Number of documents from the top of each served overview page whose
+# texts are fetched into the local cache in the background, together
+# with the collection. 0 disables prefetching.
+PREFETCH_DOCUMENTS = 0
+PREFETCH_WORKERS = 4
+PREFETCH_PER_HOST = 2
+prefetcher = Prefetcher(PREFETCH_WORKERS, PREFETCH_PER_HOST)
 
 # Variables made available to all template rendering contexts.
 template_context = {
@@ -51,16 +164,33 @@ template_context = {
     'dict': dict,
 }
 
-class FormatError(Exception):
-    pass
-
-Standoff = namedtuple('MyStandoff', 'start end type')
-
 app = flask.Flask(__name__)
 
 @app.before_request
 def log_request():
     app.logger.info('%s %s' % (flask.request, flask.request.args))
+    if memory.enabled:
+        memory.start_request()
+
+@app.after_request
+def log_memory(response):
+    """Log and keep peak memory by stage of the request if memory
+    accounting is enabled. For streamed responses, this is done when
+    the response is closed so that stages of streamed content are
+    included."""
+    if memory.enabled:
+        label = '%s %s' % (flask.request.method, flask.request.full_path)
+        if response.is_streamed:
+            response.call_on_close(lambda: _finish_memory(label))
+        else:
+            _finish_memory(label)
+    return response
+
+def _finish_memory(label):
+    peaks = memory.finish_request(label)
+    if peaks:
+        app.logger.info('peak memory by stage: %s' % ', '.join(
+            '%s %d' % (stage, peak) for stage, peak in peaks.items()))
 
 def pretty(doc):
     return json.dumps(doc, sort_keys=True, indent=2, separators=(',', ': '))
@@ -89,174 +219,6 @@ def filter_by_document(annotations, doc, target_key='target'):
             filtered.append(annotation)
     return filtered
 
-# priority order of keys in structured bodies to select as types for
-# visualization.
-_key_priority_as_type = [
-    '@id',
-    'label',
-    # Universal Dependencies coarse POS tag.
-    'ud:cpostag',
-]
-
-def _to_standoff_type(value):
-    """Convert OA body value to type for visualization."""
-    if isinstance(value, dict):
-        for key in _key_priority_as_type:
-            if key in value:
-                # TODO: don't just discard possible other items in dict
-                return value[key]
-        # Just pick the first key in default sort order
-        return value[sorted(value.keys())[0]]
-    else:
-        # TODO: cover other options also
-        return str(value)
-
-def _annotation_types(annotation):
-    """Return list of types for given OA annotation."""
-    try:
-        body = annotation['body']
-    except KeyError:
-        return ['<unknown>']
-    if isinstance(body, basestring):
-        return [body]
-    elif isinstance(body, list):
-        return [_to_standoff_type(item) for item in body]
-    else:
-        return [_to_standoff_type(body)]
-
-def annotations_to_standoffs(annotations, target_key='target'):
-    """Convert OA annotations to (start, end, type) triples."""
-    standoffs = []
-    for annotation in annotations:
-        target = annotation[target_key]
-        fragment = urlparse.urldefrag(target)[1]
-        try:
-            start_end = fragment.split('=', 1)[1]
-            start, end = start_end.split(',')
-        except IndexError:
-            app.logger.warning('failed to parse target %s' % target)
-            start, end = 0, 1
-        for type_ in _annotation_types(annotation):
-            standoffs.append(Standoff(int(start), int(end), type_))
-    return standoffs
-
-def join_urls(urls, base):
-    """Joins base URL to relative URLs."""
-    if isinstance(urls, list):
-        return [join_urls(u, base) for u in urls]
-    elif isinstance(urls, basestring):
-        if not is_relative(urls):
-            return urls
-        else:
-            return urlparse.urljoin(base, urls)
-    else:
-        raise ValueError('unexpected URLs: %s' % str(urls))
-
-def complete_relative_urls(document, base):
-    """Complete relative URLs in JSON-LD document with given base URL."""
-    # TODO: use JSON-LD expansion
-    url_keys = ('@id', 'target')
-    if isinstance(document, list):
-        return [complete_relative_urls(d, base) for d in document]
-    elif not isinstance(document, dict):
-        return document # assume primitive
-    else:
-        for key, value in document.items():
-            if key in url_keys:
-                document[key] = join_urls(value, base)
-            else:
-                document[key] = complete_relative_urls(value, base)
-        return document
-
-def is_collection(document):
-    """Return True if JSON-LD document is a collection, False otherwise."""
-    # TODO: decide on and fix '@type'
-    return ITEMS_KEY in document
-
-def is_annotation(document):
-    """Return True if JSON-LD document is an annotation, False otherwise."""
-    # TODO: resolve by expanding JSON-LD
-    if '@type' not in document:
-        return False
-    # Allow for more than one type
-    if isinstance(document['@type'], list):
-        types = document['@type']
-    else:
-        types = [document['@type']]
-    return any(t for t in ANNOTATION_TYPES if t in types)
-
-def annotation_to_collection(document):
-    """Wrap given annotation with a collection containing it."""
-    return { ITEMS_KEY: [document] }
-
-def get_collection(url):
-    """Return annotation collection from RESTful Open Annotation store."""
-    response = requests.get(url)
-    response.raise_for_status()
-    try:
-        document = response.json()
-    except Exception, e:
-        raise FormatError('failed to parse JSON')
-    # Parts of the following processing assume absolute URLs
-    document = complete_relative_urls(document, url)
-    if is_collection(document):
-        return document
-    elif is_annotation(document):
-        return annotation_to_collection(document)
-    else:
-        raise FormatError('Not recognized as collection or annotation:\n %s' %
-                          json.dumps(document, indent=2))
-
-def get_annotations(url):
-    """Return list of annotations from RESTful Open Annotation store."""
-    collection = get_collection(url)
-    annotations = collection[ITEMS_KEY]
-    return annotations
-
-def get_encoding(response):
-    """Return encoding from the Content-Type of the given response, or None
-    if no encoding is specified."""
-    # Based on get_encoding_from_headers in Python Requests utils.py.
-    # Note: by contrast to the Python Requests implementation, we do
-    # *not* here follow RFC 2616 and fall back to ISO-8859-1 (Latin 1)
-    # in the absence of a "charset" parameter for "text" content
-    # types, but simply return None.
-    content_type = response.headers.get('Content-Type')
-    if content_type is None:
-        return None
-    value, parameters = cgi.parse_header(content_type)
-    if 'charset' not in parameters:
-        return None
-    return parameters['charset'].strip("'\"")
-
-def get_document_text(url, encoding=None):
-    """Return text of document from given URL.
-
-    Currently assumes that the document is text/plain.
-    """
-    headers = { 'Accept': 'text/plain' }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    # check that we got what we wanted
-    mimetype = response.headers.get('Content-Type')
-    if not 'text/plain' in mimetype:
-        raise ValueError('requested text/plain, got %s' % mimetype)
-    # Strict RFC 2616 compliance (default to Latin 1 when no "charset"
-    # given for text) can lead to misalignment issues when servers
-    # fail to specify the encoding. To avoid this, check for missing
-    # encodings and fall back on the apparent (charted detected)
-    # encoding instead.
-    if encoding is not None:
-        response.encoding = encoding
-    elif (get_encoding(response) is None and
-          response.encoding.upper() == 'ISO-8859-1' and
-          response.apparent_encoding != response.encoding):
-        app.logger.warning('Breaking RFC 2616: ' \
-            'using detected encoding (%s) instead of default (%s)' % \
-            (response.apparent_encoding, response.encoding))
-        response.encoding = response.apparent_encoding
-    return response.text
-
 def fix_url(url):
     """Fix potentially broken or incomplete client-provided URL."""
     # Note: urlparse gives unexpected results when given an
@@ -272,9 +234,9 @@ def fix_url(url):
         url = 'http://' + url
     return url
 
-def explore_url(url):
+def explore_url(url, **overview_args):
     try:
-        return select_doc(url)
+        return select_doc(url, **overview_args)
     except FormatError, e:
         return select_url(warning='Error exploring %s: %s' % (url, str(e)))
     except Exception, e:
@@ -285,21 +247,93 @@ def explore_url(url):
             'doc': Arg(str),
             'encoding': Arg(str),
             'style': Arg(str),
+            'page': Arg(int),
+            'size': Arg(int),
+            'sort': Arg(str),
+            'prefix': Arg(str),
+            'format': Arg(str),
+            'export': Arg(str),
+            'profile': Arg(str),
+            'profile_token': Arg(str),
           })
 def explore(args):
+    if args.get('profile'):
+        return profile_explore(args)
+    else:
+        return _explore(args)
+
+def profiling_authorized(token):
+    if PROFILE_TOKEN is None or token is None:
+        return False
+    return hmac.compare_digest(str(PROFILE_TOKEN), str(token))
+
+def profile_explore(args):
+    """Process explore request under cProfile and return the profile
+    instead of the response."""
+    token = (args.get('profile_token') or
+             flask.request.headers.get('X-Profile-Token'))
+    if not profiling_authorized(token):
+        return flask.Response('Profiling not authorized.\n', status=403,
+                              mimetype='text/plain')
+    def explore_response():
+        response = flask.make_response(_explore(args))
+        # Include generating streamed content in the profile.
+        response.get_data()
+        return response
+    response, data = profile_call(explore_response)
+    app.logger.info('profiled %s: status %s' % (flask.request.url,
+                                                response.status))
+    filename = 'oaexplorer-%s.prof' % time.strftime('%Y%m%d-%H%M%S')
+    headers = { 'Content-Disposition': 'attachment; filename=%s' % filename }
+    return flask.Response(data, mimetype='application/octet-stream',
+                          headers=headers)
+
+def _explore(args):
     url, doc = args['url'], args['doc']
     encoding, style = args['encoding'], args['style']
     if url is None:
         return select_url()
     url = fix_url(url)
+    format = negotiate_format(args.get('format'))
     if doc is None:
-        return explore_url(url)
-    else:
+        overview_args = { k: args.get(k) for k in
+                          ('page', 'size', 'sort', 'prefix') }
+        return explore_url(url, format=format, **overview_args)
+    elif format in EXPORT_MIMETYPES:
+        return safe_export(url, doc, format, args.get('export'))
+    elif style == 'list':
         return safe_visualize(url, doc, encoding, style)
+    else:
+        # Visualization cost grows with annotation count and text
+        # length; limit concurrency by cost class.
+        try:
+            with admission.admit(visualization_cost(url, doc)):
+                return safe_visualize(url, doc, encoding, style)
+        except Overloaded, e:
+            return overloaded_response(e)
+
+def overloaded_response(e):
+    headers = { 'Retry-After': str(e.retry_after) }
+    return flask.Response('Server busy, please try again later.\n',
+                          status=503, mimetype='text/plain', headers=headers)
+
+def visualization_cost(url, doc):
+    """Return estimated cost of visualizing doc from collection at url
+    based on cached information, or None if nothing is known."""
+    annotation_count, text_length = None, None
+    index = document_indexes.get(url)
+    if index is not None and doc in index:
+        annotation_count = index.get(doc).count
+    entry = text_cache.get(doc)
+    if entry is not None:
+        text_length = entry['length']
+    return estimate_cost(annotation_count, text_length)
 
 def is_relative(url):
-    # URLs starting with known prefixes are considered absolute
-    if any(p for p in _prefix_full_form_map if url.startswith(p+':')):
+    # URLs starting with prefixes of the default context are
+    # considered absolute
+    prefix, colon, _ = url.partition(':')
+    if colon and prefix in DEFAULT_PREFIXES:
         return False
     else:
         return urlparse.urlparse(url).netloc == ''
@@ -324,38 +358,6 @@ def rewrite_links(collection, base, proxy_url):
     # TODO: recurse
     return new_collection
 
-# TODO: generalize
-_prefix_full_form_map = {
-    'BTO': 'http://purl.obolibrary.org/obo/BTO_',
-    'GO': 'http://purl.obolibrary.org/obo/GO_',
-    'DOID': 'http://purl.obolibrary.org/obo/DOID_',
-    'stringdb': 'http://string-db.org/interactions/',
-    'stitchdb': 'http://stitchdb-db.org/interactions/',
-    'taxonomy': 'http://www.ncbi.nlm.nih.gov/taxonomy/',
-}
-
-def expand_url(url):
-    """Expand prefixed URLs to full forms."""
-    for prefix, full_form in _prefix_full_form_map.iteritems():
-        if url.startswith(prefix + ':'):
-            return full_form + url[len(prefix)+1:]
-    return url
-
-def expand_url_prefixes(document):
-    """Expand prefixed URLs in document to full forms."""
-    # TODO: use actual JSON-LD expansion.
-    if isinstance(document, dict):
-        # expand any '@id' value with a known prefix.
-        if '@id' in document:
-            document['@id'] = expand_url(document['@id'])
-        return {
-            k: expand_url_prefixes(v) for k, v in document.iteritems()
-        }
-    elif isinstance(document, list):
-        return [expand_url_prefixes(d) for d in document]
-    else:
-        return document
-
 def safe_visualize(url, doc, encoding=None, style=None):
     # Wrapper for visualize, returns appropriate error messages on Exception.
     try:
@@ -368,56 +370,697 @@ def safe_visualize(url, doc, encoding=None, style=None):
         return select_url(warning='Cannot explore %s/%s: %s' %
                           (url, doc, str(e)))
 
-def visualize(url, doc, text_encoding=None, style=None):
-    if style is None:
-        style = 'visualize'
-
-    # We're stateless with no DB, so we need to get the annotations again
+def get_filtered(url, doc):
+    """Return collection with links rewritten to go through this proxy
+    and iterator over the normalized annotations it has for doc."""
+    # We're stateless with no DB, so we need to get the annotations
+    # again unless still cached.
+    prefetcher.used('collection', url)
     collection = get_collection(url)
     proxy_root = flask.request.base_url + '?url='
     collection = rewrite_links(collection, url, proxy_root)
-    annotations = collection[ITEMS_KEY]
+    return collection, iter_filtered(collection[ITEMS_KEY], doc)
 
-    if doc == 'all': # TODO: avoid magic string
-        filtered = annotations
-    else:
-        filtered = filter_by_document(annotations, doc)
+def stream_template(template_name, **context):
+    """Render template incrementally, returning a generator of strings."""
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(TEMPLATE_STREAM_BUFFER)
+    return stream
 
-    # Expand compacted (prefixed) forms to full URLs; the standoff
-    # conversion doesn't understand JSON-LD.
-    filtered = expand_url_prefixes(filtered)
+def visualize(url, doc, text_encoding=None, style=None):
+    if style is None:
+        style = 'visualize'
+
+    collection, filtered = get_filtered(url, doc)
 
     if style == 'list':
-        return flask.render_template('annotations.html',
-                                     collection=collection,
-                                     annotations=filtered,
-                                     **template_context)
+        stream = stream_template('annotations.html',
+                                 collection=collection,
+                                 annotations=filtered,
+                                 **template_context)
+        return flask.Response(flask.stream_with_context(stream))
     else:
-        if doc == 'all':
+        if doc == ALL_DOCUMENTS:
             return 'Sorry, can only visualize a single document at a time!'
-        standoffs = annotations_to_standoffs(filtered)
-        doc_text = get_document_text(doc, text_encoding)
-        return standoff_to_html(doc_text, standoffs,
-                                legend=True, tooltips=True, links=True)
+        with memory_stage('standoffs'):
+            standoffs = annotations_to_standoffs(filtered)
+        prefetcher.used('text', doc)
+        with memory_stage('text'):
+            doc_text = get_document_text(doc, text_encoding)
+        if style == 'client':
+            # Leave rendering to the browser
+            return standoff_to_client_html(doc_text, standoffs,
+                                           legend=True, tooltips=True,
+                                           links=True)
+        return render_page(doc_text, standoffs, **RENDER_OPTIONS)
+
+def _page_key(text, standoffs, options):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return (hashlib.sha1(text).hexdigest(),
+            hashlib.sha1(repr(standoffs)).hexdigest(),
+            tuple(sorted(options.items())))
+
+def render_page(text, standoffs, headers=None, **options):
+    """Return response with page rendered by standoff_to_html() with
+    given options.
+
+    Pages are cached compressed, so serving a cached page to a client
+    accepting a supported encoding takes neither rendering nor
+    compression. Pages simplified to fit the rendering budget are not
+    cached, so that they are rendered in full when time allows.
+    """
+    key = _page_key(text, standoffs, options)
+    cached = page_cache.get(key)
+    if cached is None:
+        if len(text) >= PARALLEL_RENDER_MIN_LENGTH:
+            processes = RENDER_PROCESSES
+        else:
+            processes = None
+        with memory_stage('render'):
+            html, mode = standoff_to_html(text, standoffs,
+                                          processes=processes,
+                                          cache=render_cache, compact=True,
+                                          budget=RENDER_BUDGET,
+                                          with_mode=True, **options)
+        with memory_stage('compress'):
+            data = html.encode('utf-8')
+            cached = (len(data), compress_variants(data))
+        if mode == FULL:
+            page_cache.set(key, cached)
+    size, variants = cached
+    headers = dict(headers or {})
+    headers['Vary'] = 'Accept-Encoding'
+    encoding = negotiate(flask.request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        encoding, data = 'identity', decompress(variants['gzip'], 'gzip')
+    else:
+        data = variants[encoding]
+        headers['Content-Encoding'] = encoding
+    byte_counts.record('downstream', encoding, size, len(data))
+    return flask.Response(data, mimetype='text/html', headers=headers)
+
+def _export_items(annotations, export):
+    for annotation in annotations:
+        if export == 'annotations':
+            yield annotation
+        else:
+            standoffs = [so._asdict() for so in
+                         annotations_to_standoffs([annotation])]
+            if export == 'standoffs':
+                for standoff in standoffs:
+                    yield standoff
+            else:
+                yield { 'annotation': annotation, 'standoffs': standoffs }
+
+def _ndjson_stream(items):
+    for item in items:
+        yield json.dumps(item) + '\n'
+
+def _json_stream(items):
+    # Emit a JSON array one item at a time instead of serializing
+    # the whole list up front.
+    separator = '[\n'
+    for item in items:
+        yield separator + json.dumps(item)
+        separator = ',\n'
+    yield '[]' if separator == '[\n' else '\n]'
+
+def export_annotations(url, doc, format, export=None):
+    """Stream annotations and/or standoffs for doc in given format."""
+    if export is None:
+        export = EXPORT_CONTENT[0]
+    if export not in EXPORT_CONTENT:
+        raise ValueError('unknown export %s' % export)
+    collection, filtered = get_filtered(url, doc)
+    items = _export_items(filtered, export)
+    if format == 'ndjson':
+        stream = _ndjson_stream(items)
+    else:
+        stream = _json_stream(items)
+    return flask.Response(flask.stream_with_context(stream),
+                          mimetype=EXPORT_MIMETYPES[format])
+
+def safe_export(url, doc, format, export=None):
+    # Wrapper for export_annotations, returns errors as JSON on Exception.
+    try:
+        return export_annotations(url, doc, format, export)
+    except Exception, e:
+        # TODO: only show str(e) in DEBUG
+        error = { 'error': 'Cannot export %s/%s: %s' % (url, doc, str(e)) }
+        return flask.Response(pretty(error), status=502,
+                              mimetype='application/json')
+
+def negotiate_format(format=None):
+    """Return response format given explicitly or by the Accept header:
+    'html' or one of the EXPORT_MIMETYPES keys."""
+    if format is not None:
+        return format
+    offered = ['text/html'] + EXPORT_MIMETYPES.values()
+    best = flask.request.accept_mimetypes.best_match(offered, 'text/html')
+    for format, mimetype in EXPORT_MIMETYPES.items():
+        if best == mimetype:
+            return format
+    return 'html'
+
+@app.route(API_ROOT + '/batch', methods=['GET', 'POST'])
+@use_args({ 'url': Arg(str),
+            'doc': Arg(str, multiple=True),
+            'encoding': Arg(str),
+            'format': Arg(str),
+          })
+def explore_batch(args):
+    """Render several documents of a collection, given by doc
+    parameters (or doc=all), as NDJSON lines or a zip archive."""
+    format = args.get('format') or BATCH_FORMATS[0]
+    if args['url'] is None or not args['doc']:
+        return json_error('url and doc required', 400)
+    elif format not in BATCH_FORMATS:
+        return json_error('unknown format %s' % format, 400)
+    url = fix_url(args['url'])
+    try:
+        annotations = get_annotations(url)
+    except Exception, e:
+        return json_error('Cannot explore %s: %s' % (url, str(e)), 502)
+    # Index the annotations at hand rather than using a cached index,
+    # whose positions may refer to an earlier fetch.
+    index = DocumentIndex(annotations)
+    docs = batch_documents(index, args['doc'])
+    if len(docs) > MAX_BATCH_DOCUMENTS:
+        return json_error('at most %d documents per batch' %
+                          MAX_BATCH_DOCUMENTS, 413)
+    cost = sum(batch_document_cost(index, doc) for doc in docs)
+    results = batch_render(annotations, index, docs, args['encoding'])
+    try:
+        if format == 'zip':
+            with admission.admit(cost):
+                return batch_zip(results)
+        # Hold admission until the streamed response is closed.
+        admitted = admission.admit(cost)
+        admitted.__enter__()
+    except Overloaded, e:
+        return overloaded_response(e)
+    response = flask.Response(_ndjson_stream(
+        { 'doc': doc, 'html': html } if error is None else
+        { 'doc': doc, 'error': error } for doc, html, error in results
+    ), mimetype=EXPORT_MIMETYPES['ndjson'])
+    response.call_on_close(lambda: admitted.__exit__(None, None, None))
+    return response
+
+def json_error(message, status):
+    return flask.Response(pretty({ 'error': message }), status=status,
+                          mimetype='application/json')
+
+def batch_document_cost(index, doc):
+    """Return estimated cost of rendering doc in a batch. Documents
+    whose text length or annotation count is unknown cost at least as
+    much as a single request of unknown cost."""
+    count, length = None, None
+    if doc in index:
+        count = index.get(doc).count
+    entry = text_cache.get(doc)
+    if entry is not None:
+        length = entry['length']
+    cost = estimate_cost(count, length) or 0
+    if count is None or length is None:
+        cost = max(cost, admission.default_cost())
+    return cost
+
+def batch_documents(index, docs):
+    """Return list of documents for doc parameters, without
+    duplicates. ALL_DOCUMENTS stands for all documents in index."""
+    if ALL_DOCUMENTS in docs:
+        return [d.title for d in index.page(0, len(index)).documents]
+    return list(OrderedDict.fromkeys(docs))
+
+_batch_pools = None
+
+# Guards creation of the pools of this process (see start_pools()).
+_pools_lock = threading.Lock()
+
+def _get_batch_pools():
+    global _batch_pools
+    with _pools_lock:
+        if _batch_pools is None:
+            # Created in each worker process, normally by start_pools().
+            from multiprocessing.pool import ThreadPool
+            if RENDER_PROCESSES is not None and RENDER_PROCESSES > 1:
+                render_pool = multiprocessing.Pool(RENDER_PROCESSES)
+            else:
+                render_pool = ThreadPool(BATCH_RENDER_THREADS)
+            _batch_pools = (ThreadPool(BATCH_FETCH_THREADS), render_pool)
+        return _batch_pools
+
+def _fetch_batch_text(job):
+    # Runs in the batch fetch pool. Texts are picked up from
+    # text_cache for rendering, so only errors are returned.
+    doc, encoding = job
+    try:
+        get_document_text(doc, encoding)
+        return None
+    except Exception, e:
+        return str(e) or e.__class__.__name__
+
+def _render_batch_document(text, standoffs):
+    # Runs in the batch render pool. Standoffs are passed as tuples as
+    # the Standoff class can't be pickled by name. Returns the HTML
+    # and the rendered partitions, as partitions cached in a pool
+    # process wouldn't otherwise reach render_cache of this one.
+    cache = _RecordingCache(render_cache)
+    html = standoff_to_html(text, map(Standoff._make, standoffs),
+                            cache=cache, compact=True,
+                            budget=RENDER_BUDGET, **RENDER_OPTIONS)
+    return html, cache.added
+
+class _RecordingCache(object):
+    """Cache wrapper recording the entries set through it."""
+    def __init__(self, cache):
+        self.cache = cache
+        self.added = []
+    def get(self, key):
+        return self.cache.get(key)
+    def set(self, key, value):
+        self.cache.set(key, value)
+        self.added.append((key, value))
+
+class _Rendered(object):
+    """Result of a rendering that needed no pool."""
+    def __init__(self, html):
+        self.html = html
+    def ready(self):
+        return True
+    def get(self, timeout=None):
+        return self.html, []
+
+def _start_batch_render(pool, annotations, index, doc, encoding):
+    standoffs = annotations_to_standoffs(
+        iter_filtered(index.annotations(doc, annotations), doc))
+    text = get_document_text(doc, encoding)
+    cached = page_cache.get(_page_key(text, standoffs, RENDER_OPTIONS))
+    if cached is not None:
+        size, variants = cached
+        return _Rendered(decompress(variants['gzip'], 'gzip').decode('utf-8'))
+    return pool.apply_async(_render_batch_document,
+                            (text, [tuple(so) for so in standoffs]))
+
+def batch_render(annotations, index, docs, encoding=None):
+    """Generate (doc, html, error) for given documents in order, with
+    error None for rendered documents and html None for failed ones.
+
+    Texts are fetched concurrently and documents rendered in the batch
+    render pool while earlier ones are being sent.
+    """
+    fetch_pool, render_pool = _get_batch_pools()
+    fetch_errors = fetch_pool.imap(_fetch_batch_text,
+                                   [(doc, encoding) for doc in docs])
+    pending = deque()
+    def finish(doc, result, error):
+        if error is None:
+            try:
+                html, partitions = result.get(BATCH_RENDER_TIMEOUT)
+                for key, partition in partitions:
+                    render_cache.set(key, partition)
+                return doc, html, None
+            except multiprocessing.TimeoutError:
+                error = 'rendering timed out'
+            except Exception, e:
+                error = str(e) or e.__class__.__name__
+        app.logger.warning('batch rendering of %s failed: %s' % (doc, error))
+        return doc, None, error
+    for doc, error in izip(docs, fetch_errors):
+        result = None
+        if error is None:
+            try:
+                result = _start_batch_render(render_pool, annotations,
+                                             index, doc, encoding)
+            except Exception, e:
+                error = str(e) or e.__class__.__name__
+        pending.append((doc, result, error))
+        while pending and (len(pending) > BATCH_RENDER_AHEAD or
+                           pending[0][2] is not None or
+                           pending[0][1].ready()):
+            yield finish(*pending.popleft())
+    while pending:
+        yield finish(*pending.popleft())
+
+def batch_zip(results):
+    """Return response with zip archive of rendered documents and an
+    index.json listing the file or error of each document."""
+    archive = tempfile.TemporaryFile()
+    entries = []
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as z:
+        for doc, html, error in results:
+            if error is None:
+                filename = urllib.quote(doc, safe='') + '.html'
+                z.writestr(filename, html.encode('utf-8'))
+                entries.append({ 'doc': doc, 'file': filename })
+            else:
+                entries.append({ 'doc': doc, 'error': error })
+        z.writestr('index.json', pretty(entries))
+    archive.seek(0)
+    return flask.send_file(archive, mimetype='application/zip',
+                           as_attachment=True,
+                           attachment_filename='documents.zip')
+
+def explore_href(url):
+    return '%s?url=%s' % (API_ROOT, urllib.quote(url))
 
 def doc_href(url, doc):
     return '%s?url=%s&doc=%s' % (API_ROOT, urllib.quote(url),
                                  urllib.quote(doc))
 
-def select_doc(url):
-    annotations = get_annotations(url)
-    groups = group_by_document(annotations)
+def overview_href(url, page=None, size=None, sort=None, prefix=None):
+    params = [('url', url), ('page', page), ('size', size), ('sort', sort),
+              ('prefix', prefix)]
+    return '%s?%s' % (API_ROOT, urllib.urlencode([
+        (k, v.encode('utf-8') if isinstance(v, unicode) else v)
+        for k, v in params if v is not None
+    ]))
+
+def get_document_index(url):
+    """Return DocumentIndex for collection at given URL, building it
+    if not cached."""
+    index = document_indexes.get(url)
+    if index is None:
+        annotations = get_annotations(url)
+        index = _restored_index(url, annotations)
+        if index is None:
+            with memory_stage('index'):
+                index = DocumentIndex(annotations)
+        document_indexes.set(url, index)
+    return index
+
+def _restored_index(url, annotations):
+    """Return index of given annotations from the cache snapshot, or
+    None if the snapshot has none for them."""
+    saved = _saved_indexes.pop(url, None)
+    if saved is not None and saved[0] is annotations:
+        return saved[1]
+    return None
+
+def select_doc(url, page=None, size=None, sort=None, prefix=None,
+               format=None):
+    if page is None or page < 1:
+        page = 1
+    if size is None or size < 1:
+        size = DEFAULT_PAGE_SIZE
+    size = min(size, MAX_PAGE_SIZE)
+    if sort not in SORT_ORDERS:
+        sort = SORT_ORDERS[0]
+    index = get_document_index(url)
+    result = index.page((page-1)*size, size, sort, prefix)
     doc_data = [ {
-        'title': d,
-        'href': doc_href(url, d),
-        'count': len(groups[d]),
-        } for d in groups ]
+        'title': d.title,
+        'href': doc_href(url, d.title),
+        'count': d.count,
+        } for d in result.documents ]
+    if PREFETCH_DOCUMENTS:
+        prefetch_overview(url, [d.title for d in result.documents])
+    page_count = max(1, (result.total + size - 1) // size)
+    def page_href(p):
+        if p < 1 or p > page_count:
+            return None
+        return overview_href(url, p, size, sort, prefix)
+    overview = {
+        'collection': url,
+        'documents': doc_data,
+        'total': result.total,
+        'page': page,
+        'pages': page_count,
+        'size': size,
+        'sort': sort,
+        'prefix': prefix,
+        'prev': page_href(page-1),
+        'next': page_href(page+1),
+    }
+    if format == 'json':
+        return flask.Response(pretty(overview),
+                              mimetype=EXPORT_MIMETYPES[format])
+    elif format == 'ndjson':
+        return flask.Response(_ndjson_stream(doc_data),
+                              mimetype=EXPORT_MIMETYPES[format])
     quoted_url = urllib.quote(url)
+    sort_hrefs = { s: overview_href(url, 1, size, s, prefix)
+                   for s in SORT_ORDERS }
     return flask.render_template('documents.html',
                                  url=quoted_url,
+                                 overview=overview,
                                  documents=doc_data,
+                                 sort_hrefs=sort_hrefs,
                                  **template_context)
     
+@app.route(API_ROOT + '/federated')
+@use_args({ 'url': Arg(str, multiple=True),
+            'doc': Arg(str),
+            'encoding': Arg(str),
+            'page': Arg(int),
+            'size': Arg(int),
+            'sort': Arg(str),
+            'prefix': Arg(str),
+            'timeout': Arg(float),
+          })
+def explore_federated(args):
+    """Explore annotations of several stores together."""
+    urls = [fix_url(u) for u in args['url'] or []][:MAX_FEDERATED_STORES]
+    if not urls:
+        return select_url()
+    timeout = FEDERATED_TIMEOUT
+    if args.get('timeout') is not None:
+        timeout = max(0, min(args['timeout'], FEDERATED_TIMEOUT))
+    doc = args['doc']
+    try:
+        index, errors = get_federated_index(urls, timeout)
+        if doc is None:
+            overview_args = { k: args.get(k) for k in
+                              ('page', 'size', 'sort', 'prefix') }
+            return select_federated_doc(urls, index, errors, **overview_args)
+        entry = index.get(doc)
+        cost = estimate_cost(entry.count if entry is not None else 0,
+                             (text_cache.get(doc) or {}).get('length'))
+        with admission.admit(cost):
+            return visualize_federated(urls, index, errors, doc,
+                                       args['encoding'])
+    except Overloaded, e:
+        return overloaded_response(e)
+    except Exception, e:
+        return select_url(warning='Cannot explore %s: %s' %
+                          (', '.join(urls), str(e)))
+
+_federation_pool = None
+
+# Fetches in the federation pool. Fetches that time out can't be
+# cancelled and keep their thread until done, so each holds a slot
+# until then, and stores are reported busy rather than queued behind
+# them when no slot is free.
+_federation_slots = threading.BoundedSemaphore(FEDERATION_THREADS)
+
+def _get_federation_pool():
+    global _federation_pool
+    with _pools_lock:
+        if _federation_pool is None:
+            # Created in each worker process, normally by start_pools().
+            from multiprocessing.pool import ThreadPool
+            _federation_pool = ThreadPool(FEDERATION_THREADS)
+        return _federation_pool
+
+def _federated_fetch(url, timeout):
+    try:
+        return get_collection(url, timeout)
+    finally:
+        _federation_slots.release()
+
+def get_federated(urls, timeout=FEDERATED_TIMEOUT):
+    """Fetch collections from given URLs concurrently, waiting at most
+    timeout seconds in total.
+
+    Return list of collections (None for failed) and list of error
+    messages (None for success).
+    """
+    pool = _get_federation_pool()
+    pending = []
+    for url in urls:
+        if _federation_slots.acquire(False):
+            pending.append(pool.apply_async(_federated_fetch, (url, timeout)))
+        else:
+            pending.append(None)
+    deadline = time.time() + timeout
+    collections, errors = [], []
+    for url, result in zip(urls, pending):
+        try:
+            if result is None:
+                raise UpstreamBusy('too many pending fetches')
+            collection = result.get(max(0, deadline - time.time()))
+            error = None
+        except multiprocessing.TimeoutError:
+            collection = None
+            error = 'no response in %g seconds' % timeout
+        except Exception, e:
+            collection = None
+            error = str(e) or e.__class__.__name__
+        if error is not None:
+            app.logger.warning('federated fetch of %s failed: %s' %
+                               (url, error))
+        collections.append(collection)
+        errors.append(error)
+    return collections, errors
+
+def get_federated_index(urls, timeout=FEDERATED_TIMEOUT):
+    """Return FederatedIndex of the collections at given URLs and list
+    of errors by URL (None for success), fetching the collections if
+    the index isn't cached. Only indexes of complete results are
+    cached."""
+    key = ('federated',) + tuple(urls)
+    index = document_indexes.get(key)
+    if index is not None:
+        return index, [None] * len(urls)
+    collections, errors = get_federated(urls, timeout)
+    index = FederatedIndex([c[ITEMS_KEY] if c is not None else []
+                            for c in collections])
+    if not any(errors):
+        document_indexes.set(key, index)
+    return index, errors
+
+def source_labels(urls):
+    """Return labels identifying stores in federated views."""
+    return ['store %d (%s)' % (i+1, urlparse.urlparse(u).netloc)
+            for i, u in enumerate(urls)]
+
+def federated_href(urls, **params):
+    items = [('url', u) for u in urls] + [
+        (k, v.encode('utf-8') if isinstance(v, unicode) else v)
+        for k, v in sorted(params.items()) if v is not None
+    ]
+    return '%s/federated?%s' % (API_ROOT, urllib.urlencode(items))
+
+def select_federated_doc(urls, index, errors, page=None, size=None,
+                         sort=None, prefix=None):
+    if page is None or page < 1:
+        page = 1
+    if size is None or size < 1:
+        size = DEFAULT_PAGE_SIZE
+    size = min(size, MAX_PAGE_SIZE)
+    if sort not in SORT_ORDERS:
+        sort = SORT_ORDERS[0]
+    labels = source_labels(urls)
+    result = index.page((page-1)*size, size, sort, prefix)
+    doc_data = [ {
+        'title': d.title,
+        'href': federated_href(urls, doc=d.title),
+        'count': d.count,
+        'sources': zip(labels, index.source_counts(d.title)),
+        } for d in result.documents ]
+    page_count = max(1, (result.total + size - 1) // size)
+    def page_href(p):
+        if p < 1 or p > page_count:
+            return None
+        return federated_href(urls, page=p, size=size, sort=sort,
+                              prefix=prefix)
+    stores = [ {
+        'url': url,
+        'label': label,
+        'href': explore_href(url),
+        'count': len(annotations),
+        'error': error,
+        } for url, label, annotations, error
+        in zip(urls, labels, index.annotation_lists, errors) ]
+    overview = {
+        'total': result.total,
+        'page': page,
+        'pages': page_count,
+        'prev': page_href(page-1),
+        'next': page_href(page+1),
+    }
+    return flask.render_template('federated.html',
+                                 stores=stores,
+                                 overview=overview,
+                                 documents=doc_data,
+                                 **template_context)
+
+def federated_standoffs(index, doc, labels):
+    """Return standoffs for doc with one layer per source.
+
+    The type of each standoff is the label of its source, so that
+    sources are shown in different colors, and annotation types are
+    given as the types of the collapsed standoffs for tooltips.
+    """
+    grouped = OrderedDict()
+    for source, annotation in index.sources(doc):
+        for so in annotations_to_standoffs([annotation]):
+            key = (so.start, so.end, labels[source])
+            counts = grouped.get(key)
+            if counts is None:
+                counts = grouped[key] = OrderedDict()
+            counts[so.type] = counts.get(so.type, 0) + 1
+    return [CollapsedStandoff(start, end, label, sum(counts.values()),
+                              counts.items())
+            for (start, end, label), counts in grouped.iteritems()]
+
+def visualize_federated(urls, index, errors, doc, text_encoding=None):
+    standoffs = federated_standoffs(index, doc, source_labels(urls))
+    doc_text = get_document_text(doc, text_encoding)
+    headers = {}
+    unavailable = [u for u, e in zip(urls, errors) if e is not None]
+    if unavailable:
+        headers['X-Unavailable-Stores'] = ' '.join(unavailable)
+    return render_page(doc_text, standoffs, headers, legend=True,
+                       tooltips=True, collapse=False)
+
+def prefetch_overview(url, docs):
+    """Prefetch collection at url and the texts of the first
+    PREFETCH_DOCUMENTS of docs in the background."""
+    if url not in collection_cache:
+        prefetcher.submit('collection', url, get_collection, url)
+    for doc in docs[:PREFETCH_DOCUMENTS]:
+        if text_cache.get(doc) is None:
+            prefetcher.submit('text', doc, get_document_text, doc)
+
+@app.after_request
+def compress_response(response):
+    """Compress response if the client accepts a supported encoding
+    and the content is worth compressing."""
+    if (response.status_code < 200 or response.status_code in (204, 304) or
+        'Content-Encoding' in response.headers or
+        not compressible(response.mimetype)):
+        return response
+    response.vary.add('Accept-Encoding')
+    accept_encoding = flask.request.headers.get('Accept-Encoding')
+    if response.is_streamed:
+        # Only gzip is compressed incrementally.
+        if negotiate(accept_encoding, ['gzip']) is None:
+            return response
+        response.response = compress_stream(response.response)
+        response.headers.pop('Content-Length', None)
+        response.headers['Content-Encoding'] = 'gzip'
+        return response
+    data = response.get_data()
+    encoding = negotiate(accept_encoding)
+    if encoding is None or len(data) < MIN_SIZE:
+        return response
+    compressed = compress(data, encoding)
+    byte_counts.record('downstream', encoding, len(data), len(compressed))
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def metrics():
+    """Return dict of counters describing the operation of this process."""
+    return {
+        'render_modes': dict(render_mode_counts),
+        'admission': admission.stats(),
+        'prefetch': prefetcher.stats(),
+        'compression': byte_counts.stats(),
+        'page_cache': page_cache.stats(),
+        'upstream': upstream.stats(),
+        'jsonld': jsonld.stats(),
+        'memory': memory.stats(),
+    }
+
+@app.route(API_ROOT + '/metrics')
+def show_metrics():
+    return flask.Response(pretty(metrics()), mimetype='application/json')
+
 @app.route(API_ROOT + '/<path:url>')
 def explore_path(url):
     return explore({'url': url})
@@ -433,13 +1076,170 @@ def root():
 def select_url(**args):
     return flask.render_template('index.html', root=API_ROOT, **args)
 
+def snapshot_contents():
+    """Return dict of cache contents for snapshot.
+
+    Only collections that can be revalidated with the store are
+    included, each with its document index (or None) so that the
+    snapshots of different processes merge consistently. Document
+    texts are not included as the text cache is kept on disk.
+    """
+    validators = dict(collection_validators.items())
+    collections = {}
+    for url, collection in collection_cache.items():
+        etag, last_modified = validators.get(url, (None, None))
+        if etag is not None or last_modified is not None:
+            collections[url] = (collection, etag, last_modified,
+                                document_indexes.get(url))
+    return {
+        'collections': collections,
+        'pages': page_cache.items(),
+    }
+
+def restored_snapshot():
+    """Return contents of the cache snapshot, or an empty dict if
+    snapshots aren't enabled.
+
+    The snapshot is read on first call. Rendered pages, which are
+    keyed by content and need no validation, are then restored into
+    page_cache. Collections and document indexes are restored when
+    validated (see _saved_collection()).
+    """
+    global _snapshot_restored
+    if snapshot is None:
+        return {}
+    with _snapshot_lock:
+        restored = snapshot.load()
+        if not _snapshot_restored:
+            _snapshot_restored = True
+            for key, page in restored.pop('pages', []):
+                page_cache.set(key, page)
+        return restored
+
+def _saved_collection(url):
+    """Return (collection, etag, last_modified) saved for URL in the
+    cache snapshot, or None. oastore.fetch_collection() uses the
+    collection if the store confirms that it is current, and
+    get_document_index() then uses its saved index."""
+    saved = restored_snapshot().get('collections', {}).pop(url, None)
+    if saved is None:
+        return None
+    collection, etag, last_modified, index = saved
+    if index is not None:
+        _saved_indexes[url] = (collection[ITEMS_KEY], index)
+    return collection, etag, last_modified
+
+def start_snapshots(path):
+    """Restore caches from the snapshots of all processes at given
+    path and save those of this process there every SNAPSHOT_INTERVAL
+    seconds (see snapshot.Snapshot)."""
+    global snapshot
+    snapshot = Snapshot(path, SNAPSHOT_MAX_AGE)
+    oastore.saved_collection = _saved_collection
+    # Read in the background so that requests don't wait for it
+    # unless they need it.
+    loader = threading.Thread(target=restored_snapshot)
+    loader.daemon = True
+    loader.start()
+    writer = SnapshotWriter(snapshot, snapshot_contents, SNAPSHOT_INTERVAL)
+    writer.start()
+    return writer
+
+def start_sampling_profiler(directory):
+    """Start recording stacks of rendering and upstream fetches in
+    this process, writing them periodically to given directory."""
+    profiler = SamplingProfiler(directory, SAMPLED_FILES, SAMPLED_FUNCTIONS)
+    profiler.start()
+    return profiler
+
+def warm_up():
+    """Prepare this process for serving requests.
+
+    Compiles templates and exercises the rendering code paths so that
+    the first requests don't pay for one-time setup.
+    """
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    jsonld.expand({ '@id': 'GO:0000000' })
+    standoffs = [Standoff(0, 7, 'http://purl.obolibrary.org/obo/GO_0000000')]
+    standoff_to_html(u'warm up', standoffs, tooltips=True, links=True,
+                     compact=True)
+
+def start_pools():
+    """Create the worker pools of this process before serving starts
+    rather than in request threads (see so2html.start_pool())."""
+    if RENDER_PROCESSES is not None and RENDER_PROCESSES > 1:
+        start_pool(RENDER_PROCESSES)
+    _get_batch_pools()
+    _get_federation_pool()
+
+def argparser():
+    ap = argparse.ArgumentParser(description='RESTful OA explorer')
+    ap.add_argument('-H', '--host', default='0.0.0.0', help='host to bind')
+    ap.add_argument('-p', '--port', type=int, default=7000,
+                    help='port to listen on')
+    ap.add_argument('-P', '--production', default=False, action='store_true',
+                    help='serve with preforked workers (requires gunicorn)')
+    ap.add_argument('-w', '--workers', type=int, default=None,
+                    help='number of worker processes (default 2*cores+1)')
+    ap.add_argument('-t', '--threads', type=int, default=None,
+                    help='number of threads per worker')
+    ap.add_argument('-k', '--worker-class', default='gthread',
+                    help='gunicorn worker class, e.g. gthread or gevent')
+    ap.add_argument('-m', '--max-requests', type=int, default=1000,
+                    help='recycle workers after this many requests')
+    ap.add_argument('-f', '--prefetch', metavar='N', type=int, default=0,
+                    help='prefetch texts of top N documents of overviews')
+    ap.add_argument('-C', '--cache-snapshot', metavar='FILE', default=None,
+                    help='save caches to FILE.PID and restore them on start')
+    ap.add_argument('-M', '--trace-memory', default=False,
+                    action='store_true',
+                    help='record peak memory of processing stages')
+    ap.add_argument('-s', '--sample-profile', metavar='DIR', default=None,
+                    help='write sampled stacks to DIR (flamegraph format)')
+    return ap
+
 def main(argv):
-    # TODO: don't serve directly
-    #app.logger.addHandler(log_handler())
+    global RENDER_PROCESSES, PREFETCH_DOCUMENTS
+    args = argparser().parse_args(argv[1:])
+    PREFETCH_DOCUMENTS = args.prefetch
+    if args.trace_memory and not memory.available():
+        print >> sys.stderr, 'Error: --trace-memory: no way to measure ' \
+            'memory on this platform'
+        return 1
+    if args.production:
+        from serve import serve
+        # Worker processes already occupy the cores.
+        RENDER_PROCESSES = None
+        def worker_init():
+            # Threads don't survive fork(), so start in each worker.
+            if args.sample_profile:
+                start_sampling_profiler(args.sample_profile)
+            if args.cache_snapshot:
+                start_snapshots(args.cache_snapshot)
+            if args.trace_memory:
+                memory.enable()
+            start_pools()
+            warm_up()
+        try:
+            serve(app, args.host, args.port, args.workers, args.threads,
+                  args.worker_class, args.max_requests, warm_up=worker_init)
+        except ImportError, e:
+            print >> sys.stderr, 'Error: %s' % str(e)
+            return 1
+        return 0
+    if args.sample_profile:
+        start_sampling_profiler(args.sample_profile)
+    if args.cache_snapshot:
+        start_snapshots(args.cache_snapshot)
+    if args.trace_memory:
+        memory.enable()
+    start_pools()
     if not DEBUG:
-        app.run(host='0.0.0.0', port=7000, debug=False)
+        app.run(host=args.host, port=args.port, debug=False)
     else:
-        app.run(debug=DEBUG, port=7000)
+        app.run(debug=DEBUG, port=args.port)
+    return 0
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+
+"""Access to RESTful Open Annotation stores.
+
+Fetches and caches annotation collections and document texts, and
+converts annotations into standoffs for visualization. Used by the
+explorer (oaexplorer.py) and by command-line tools such as
+oa2spans.py.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import json
+import urlparse
+import os
+import cgi
+import time
+import tempfile
+import logging
+
+import requests
+
+from collections import namedtuple
+
+from cache import LRUCache
+from textcache import TextCache
+from profiling import memory_stage
+from compression import byte_counts, ACCEPT_ENCODING
+from upstream import UpstreamScheduler
+from compact import CompactAnnotations, values_of
+from jsonld import Processor, ContextLoader, ContextError
+
+# Key for the list of collection items in RESTful OA collection
+# response.
+ITEMS_KEY = '@graph'
+
+# Open Annotation vocabulary namespace.
+OA_NS = 'http://www.w3.org/ns/oa#'
+
+# JSON-LD @type identifying an OA annotation.
+ANNOTATION_TYPE = OA_NS + 'Annotation'
+
+# JSON-LD context applied to store responses before their own
+# contexts, defining the terms and prefixes of stores that don't give
+# a context.
+DEFAULT_CONTEXT = {
+    'oa': OA_NS,
+    'target': { '@id': 'oa:hasTarget', '@type': '@id' },
+    'body': { '@id': 'oa:hasBody' },
+    'BTO': 'http://purl.obolibrary.org/obo/BTO_',
+    'GO': 'http://purl.obolibrary.org/obo/GO_',
+    'DOID': 'http://purl.obolibrary.org/obo/DOID_',
+    'stringdb': 'http://string-db.org/interactions/',
+    'stitchdb': 'http://stitchdb-db.org/interactions/',
+    'taxonomy': 'http://www.ncbi.nlm.nih.gov/taxonomy/',
+}
+
+# Terms of the default context that map directly to an IRI and can
+# serve as prefixes of compact IRIs.
+DEFAULT_PREFIXES = set(t for t, v in DEFAULT_CONTEXT.iteritems()
+                       if isinstance(v, basestring))
+
+# Keys of annotation properties by IRI. Annotations are stored with
+# these keys whatever terms their contexts use for the properties.
+PROPERTY_KEYS = {
+    OA_NS + 'hasTarget': 'target',
+    OA_NS + 'hasBody': 'body',
+}
+
+# Document value selecting all documents of a collection.
+ALL_DOCUMENTS = 'all'
+
+# Recently fetched collections, keyed by URL. Entries are kept for
+# COLLECTION_MAX_AGE seconds so that following a link from an overview
+# doesn't fetch the collection again. The cache holds the collections
+# of a federated view (see oaexplorer.MAX_FEDERATED_STORES) with room
+# to spare.
+COLLECTION_MAX_AGE = 60
+COLLECTION_CACHE_SIZE = 25
+collection_cache = LRUCache(maxsize=COLLECTION_CACHE_SIZE,
+                            ttl=COLLECTION_MAX_AGE)
+
+# ETag and Last-Modified values of fetched collections, keyed by URL.
+collection_validators = LRUCache(maxsize=100)
+
+# Source of collections saved earlier, e.g. in a cache snapshot: None,
+# or a function returning (collection, etag, last_modified) for a URL,
+# or None if nothing is saved for it. Saved collections are used if
+# the store confirms that they are current (see fetch_collection()).
+saved_collection = None
+
+# Local cache of document texts. Cached texts are used without
+# revalidation for TEXT_MAX_AGE seconds.
+TEXT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'oaexplorer-texts')
+TEXT_CACHE_MAX_BYTES = 1024**3
+TEXT_MAX_AGE = 60
+text_cache = TextCache(TEXT_CACHE_DIR, TEXT_CACHE_MAX_BYTES)
+
+# Adaptive limits on concurrent requests to each upstream host.
+upstream = UpstreamScheduler()
+
+# Maximum sizes of upstream responses in bytes.
+MAX_COLLECTION_BYTES = 200 * 1024**2
+MAX_TEXT_BYTES = 50 * 1024**2
+MAX_CONTEXT_BYTES = 1024**2
+
+# Local cache of remote JSON-LD contexts, which are used without
+# revalidation for CONTEXT_MAX_AGE seconds.
+CONTEXT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'oaexplorer-contexts')
+CONTEXT_MAX_AGE = 24 * 3600
+CONTEXT_TIMEOUT = 10
+
+class FormatError(Exception):
+    pass
+
+class ResponseTooLarge(FormatError):
+    pass
+
+Standoff = namedtuple('MyStandoff', 'start end type')
+
+# priority order of keys in structured bodies to select as types for
+# visualization.
+_key_priority_as_type = [
+    '@id',
+    'label',
+    # Universal Dependencies coarse POS tag.
+    'ud:cpostag',
+]
+
+def _to_standoff_type(value):
+    """Convert OA body value to type for visualization."""
+    if isinstance(value, dict):
+        for key in _key_priority_as_type:
+            if key in value:
+                # TODO: don't just discard possible other items in dict
+                return value[key]
+        # Just pick the first key in default sort order
+        return value[sorted(value.keys())[0]]
+    else:
+        # TODO: cover other options also
+        return str(value)
+
+def _annotation_types(annotation):
+    """Return list of types for given OA annotation."""
+    try:
+        body = annotation['body']
+    except KeyError:
+        return ['<unknown>']
+    if isinstance(body, basestring):
+        return [body]
+    elif isinstance(body, list):
+        return [_to_standoff_type(item) for item in body]
+    else:
+        return [_to_standoff_type(body)]
+
+def annotations_to_standoffs(annotations, target_key='target'):
+    """Convert OA annotations to (start, end, type) triples."""
+    standoffs = []
+    for annotation in annotations:
+        target = annotation[target_key]
+        fragment = urlparse.urldefrag(target)[1]
+        try:
+            start_end = fragment.split('=', 1)[1]
+            start, end = start_end.split(',')
+        except IndexError:
+            logging.getLogger(__name__).warning(
+                'failed to parse target %s' % target)
+            start, end = 0, 1
+        for type_ in _annotation_types(annotation):
+            standoffs.append(Standoff(int(start), int(end), type_))
+    return standoffs
+
+def iter_filtered(annotations, doc):
+    """Generate annotations targeting doc (all for ALL_DOCUMENTS)."""
+    if doc == ALL_DOCUMENTS:
+        return iter(annotations)
+    else:
+        # Check targets first so that compactly stored annotations are
+        # only reconstructed when selected.
+        return (annotations[i] for i, target in
+                enumerate(values_of(annotations, 'target'))
+                if urlparse.urldefrag(target)[0] == doc)
+
+def is_collection(document, context=None):
+    """Return True if JSON-LD document is a collection, False otherwise."""
+    # TODO: decide on and fix '@type'
+    context = context or jsonld.initial
+    return context.find_key(document, ITEMS_KEY) is not None
+
+def is_annotation(document, context=None):
+    """Return True if JSON-LD document is an annotation, False otherwise."""
+    return ANNOTATION_TYPE in jsonld.types(document, context)
+
+def annotation_to_collection(document):
+    """Wrap given annotation with a collection containing it."""
+    return { ITEMS_KEY: [document] }
+
+def fetch(url, max_bytes, headers=None, timeout=None):
+    """GET given URL, raising ResponseTooLarge if the response body
+    exceeds max_bytes.
+
+    Waits for the upstream scheduler to allow the request, raising
+    UpstreamBusy if it doesn't in time.
+    """
+    headers = dict(headers or {})
+    headers.setdefault('Accept-Encoding', ACCEPT_ENCODING)
+    with upstream.slot(url, timeout, ignore=(ResponseTooLarge,)) as slot:
+        response = requests.get(url, headers=headers, stream=True,
+                                timeout=timeout)
+        slot.responded()
+        # Server errors and rate limiting suggest overload.
+        slot.error = (response.status_code >= 500 or
+                      response.status_code == 429)
+        chunks, size = read_content(response, url, max_bytes)
+    # Store the body as requests does after reading it in full so that
+    # response.text, response.json() etc. work as usual.
+    response._content = ''.join(chunks)
+    if hasattr(response.raw, 'tell'):
+        # bytes read from the connection, before decoding
+        byte_counts.record('upstream',
+                           response.headers.get('Content-Encoding',
+                                                'identity'),
+                           size, response.raw.tell())
+    return response
+
+def fetch_context(url):
+    """Return JSON-LD document with remote context from given URL."""
+    response = fetch(url, MAX_CONTEXT_BYTES, timeout=CONTEXT_TIMEOUT,
+                     headers={ 'Accept': 'application/ld+json, '
+                               'application/json;q=0.9' })
+    response.raise_for_status()
+    return response.json()
+
+# JSON-LD processing of store responses. Compiled contexts are shared
+# between collections.
+jsonld = Processor(DEFAULT_CONTEXT, PROPERTY_KEYS,
+                   ContextLoader(fetch_context, CONTEXT_CACHE_DIR,
+                                 CONTEXT_MAX_AGE))
+
+def read_content(response, url, max_bytes):
+    """Return list of chunks of the body of streamed response and
+    their total size."""
+    length = response.headers.get('Content-Length')
+    if length is not None and length.isdigit() and int(length) > max_bytes:
+        response.close()
+        raise ResponseTooLarge('%s: %s bytes exceeds limit' % (url, length))
+    # iter_content() decompresses as data arrives, so the limit
+    # applies to the decoded size.
+    chunks, size = [], 0
+    for chunk in response.iter_content(64*1024):
+        size += len(chunk)
+        if size > max_bytes:
+            response.close()
+            raise ResponseTooLarge('%s: more than %d bytes' % (url, max_bytes))
+        chunks.append(chunk)
+    return chunks, size
+
+def get_collection(url, timeout=None):
+    """Return annotation collection from RESTful Open Annotation store.
+
+    Collections are cached for COLLECTION_MAX_AGE seconds. The returned
+    document is shared and must not be modified.
+    """
+    collection = collection_cache.get(url)
+    if collection is None:
+        collection = fetch_collection(url, timeout)
+        collection_cache.set(url, collection)
+    return collection
+
+def fetch_collection(url, timeout=None):
+    """Fetch annotation collection, bypassing the cache.
+
+    If a collection is saved for the URL (see saved_collection), it
+    is returned if the store confirms that it is current.
+    """
+    saved = saved_collection(url) if saved_collection is not None else None
+    headers = {}
+    if saved is not None:
+        collection, etag, last_modified = saved
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+    with memory_stage('collection.fetch'):
+        response = fetch(url, MAX_COLLECTION_BYTES, headers=headers,
+                         timeout=timeout)
+    if saved is not None and response.status_code == 304:
+        collection_validators.set(url, (etag, last_modified))
+        return collection
+    response.raise_for_status()
+    collection_validators.set(url, (response.headers.get('ETag'),
+                                    response.headers.get('Last-Modified')))
+    try:
+        with memory_stage('collection.parse'):
+            document = response.json()
+    except Exception, e:
+        raise FormatError('failed to parse JSON')
+    if not isinstance(document, dict):
+        raise FormatError('Not recognized as collection or annotation')
+    try:
+        context = jsonld.document_context(document, url)
+    except ContextError, e:
+        logging.getLogger(__name__).warning(
+            '%s: %s, using default context' % (url, str(e)))
+        context = jsonld.initial
+    # Expansion makes IRIs absolute and normalizes keys, which the
+    # following processing assumes.
+    items_key = context.find_key(document, ITEMS_KEY)
+    if items_key is not None:
+        items = document.pop(items_key)
+        if not isinstance(items, list):
+            items = [items]
+        collection = jsonld.expand(document, context, url)
+        # Expand items one at a time into the compact form, which is
+        # kept as collections are cached.
+        with memory_stage('collection.expand'):
+            collection[ITEMS_KEY] = CompactAnnotations(
+                jsonld.expand_items(items, context, url))
+    elif is_annotation(document, context):
+        collection = annotation_to_collection(
+            CompactAnnotations([jsonld.expand(document, context, url)]))
+    else:
+        raise FormatError('Not recognized as collection or annotation:\n %s' %
+                          json.dumps(document, indent=2))
+    return collection
+
+def get_annotations(url):
+    """Return list of annotations from RESTful Open Annotation store."""
+    collection = get_collection(url)
+    annotations = collection[ITEMS_KEY]
+    return annotations
+
+def get_encoding(response):
+    """Return encoding from the Content-Type of the given response, or None
+    if no encoding is specified."""
+    # Based on get_encoding_from_headers in Python Requests utils.py.
+    # Note: by contrast to the Python Requests implementation, we do
+    # *not* here follow RFC 2616 and fall back to ISO-8859-1 (Latin 1)
+    # in the absence of a "charset" parameter for "text" content
+    # types, but simply return None.
+    content_type = response.headers.get('Content-Type')
+    if content_type is None:
+        return None
+    value, parameters = cgi.parse_header(content_type)
+    if 'charset' not in parameters:
+        return None
+    return parameters['charset'].strip("'\"")
+
+def get_document_text(url, encoding=None, start=0, end=None):
+    """Return text of document from given URL, or range [start, end)
+    of it.
+
+    Currently assumes that the document is text/plain. Texts are
+    cached locally and revalidated with the origin when older than
+    TEXT_MAX_AGE seconds.
+    """
+    entry = text_cache.get(url)
+    if entry is not None and encoding not in (None, entry['encoding']):
+        entry = None # cached text decoded differently
+    if entry is not None and time.time()-entry['validated'] < TEXT_MAX_AGE:
+        text = text_cache.text(entry, start, end)
+        if text is not None:
+            return text
+        entry = None # evicted by another process
+    headers = { 'Accept': 'text/plain' }
+    if entry is not None:
+        if entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified'] is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
+    response = fetch(url, MAX_TEXT_BYTES, headers=headers)
+    if entry is not None and response.status_code == 304:
+        text_cache.validated(url)
+        text = text_cache.text(entry, start, end)
+        if text is not None:
+            return text
+        # evicted by another process since validation started
+        response = fetch(url, MAX_TEXT_BYTES,
+                         headers={ 'Accept': 'text/plain' })
+    response.raise_for_status()
+    # check that we got what we wanted
+    mimetype = response.headers.get('Content-Type')
+    if not 'text/plain' in mimetype:
+        raise ValueError('requested text/plain, got %s' % mimetype)
+    # Strict RFC 2616 compliance (default to Latin 1 when no "charset"
+    # given for text) can lead to misalignment issues when servers
+    # fail to specify the encoding. To avoid this, check for missing
+    # encodings and fall back on the apparent (charted detected)
+    # encoding instead.
+    if encoding is not None:
+        response.encoding = encoding
+    elif (get_encoding(response) is None and
+          response.encoding.upper() == 'ISO-8859-1' and
+          response.apparent_encoding != response.encoding):
+        logging.getLogger(__name__).warning('Breaking RFC 2616: ' \
+            'using detected encoding (%s) instead of default (%s)' % \
+            (response.apparent_encoding, response.encoding))
+        response.encoding = response.apparent_encoding
+    text = response.text
+    # The resolved encoding is stored so that detection isn't repeated
+    # for texts served from the cache.
+    text_cache.put(url, text, response.encoding,
+                   response.headers.get('ETag'),
+                   response.headers.get('Last-Modified'))
+    return text[start:end]
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""Background prefetching for the RESTful Open Annotation explorer.
+
+Resources that users are likely to request next (e.g. the texts of
+the first documents listed in an overview) are fetched into the local
+caches by a small pool of background threads, with a limit on
+concurrent fetches per upstream host. Hits, i.e. prefetched resources
+that are later requested, are counted to tell whether prefetching
+pays off.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import Queue
+import logging
+import threading
+import urlparse
+
+from collections import defaultdict, deque, OrderedDict
+
+class Prefetcher(object):
+    """Bounded pool of threads calling prefetch functions.
+
+    Resources are identified by (kind, url) keys. At most per_host
+    prefetches run concurrently for any one host, and at most
+    queue_size wait; further submissions are dropped. Threads are
+    started on first use so that prefetchers created before forking
+    work in the child processes.
+    """
+
+    def __init__(self, workers=4, per_host=2, queue_size=100,
+                 remember=1000):
+        self.workers = workers
+        self.per_host = per_host
+        self.queue_size = queue_size
+        self.remember = remember
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pending = set()
+        self._active = defaultdict(int)
+        self._waiting = defaultdict(deque)
+        self._queued = 0
+        # Prefetched keys not yet requested, oldest first.
+        self._prefetched = OrderedDict()
+        self.counts = defaultdict(int)
+
+    def submit(self, kind, url, func, *args):
+        """Schedule func(*args) to prefetch resource of given kind
+        at url. Return True if scheduled, False if skipped."""
+        key = (kind, url)
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            if key in self._pending or key in self._prefetched:
+                self.counts['skipped'] += 1
+                return False
+            if self._queued >= self.queue_size:
+                self.counts['dropped'] += 1
+                return False
+            if not self._threads:
+                self._start()
+            self._pending.add(key)
+            self._queued += 1
+            self.counts['submitted'] += 1
+            task = (host, key, func, args)
+            if self._active[host] < self.per_host:
+                self._active[host] += 1
+                self._queue.put(task)
+            else:
+                self._waiting[host].append(task)
+            return True
+
+    def used(self, kind, url):
+        """Record a request for resource; return True if it was
+        prefetched."""
+        with self._lock:
+            self.counts['requested'] += 1
+            if self._prefetched.pop((kind, url), None) is None:
+                return False
+            self.counts['hits'] += 1
+            return True
+
+    def stats(self):
+        """Return dict of counters, with hit rate as the fraction of
+        completed prefetches that were requested."""
+        with self._lock:
+            stats = dict(self.counts)
+            stats['queued'] = self._queued
+            completed = self.counts['completed']
+            stats['hit_rate'] = (float(self.counts['hits']) / completed
+                                 if completed else None)
+        return stats
+
+    def _start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run,
+                                      name='Prefetcher-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            host, key, func, args = self._queue.get()
+            try:
+                func(*args)
+                succeeded = True
+            except Exception, e:
+                logging.getLogger(__name__).warning(
+                    'prefetching %s failed: %s' % (key[1], str(e)))
+                succeeded = False
+            with self._lock:
+                self._pending.discard(key)
+                self._queued -= 1
+                if succeeded:
+                    self.counts['completed'] += 1
+                    self._prefetched[key] = True
+                    while len(self._prefetched) > self.remember:
+                        self._prefetched.popitem(last=False)
+                        self.counts['expired'] += 1
+                else:
+                    self.counts['failed'] += 1
+                # Hand the host's slot to its next waiting task.
+                if self._waiting[host]:
+                    self._queue.put(self._waiting[host].popleft())
+                else:
+                    self._active[host] -= 1
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+
+"""Profiling support for the RESTful Open Annotation explorer.
+
+Provides per-call profiling with cProfile, with results in the
+binary format read by pstats and tools such as snakeviz and
+flameprof, and a low-rate sampling profiler that periodically writes
+aggregated stacks of selected code to files in the "collapsed" format
+read by flamegraph.pl.
+
+Also provides optional accounting of the peak memory used in stages
+of processing, measured with tracemalloc where available and from the
+resident set size of the process otherwise.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import os
+import re
+import sys
+import time
+import marshal
+import cProfile
+import threading
+
+from collections import defaultdict
+from collections import deque
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 without pytracemalloc
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    # not Unix
+    resource = None
+
+def profile_call(func, *args, **kwargs):
+    """Call func with given arguments under cProfile, returning the
+    result and the profile data as a string readable by pstats.Stats.
+    """
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func, *args, **kwargs)
+    profiler.create_stats()
+    # Same format as written by Profile.dump_stats()
+    return result, marshal.dumps(profiler.stats)
+
+class SamplingProfiler(threading.Thread):
+    """Background thread sampling the stacks of other threads.
+
+    Only stacks including code from one of the given files (by base
+    name, e.g. "so2html.py") or functions (by name) are recorded.
+    Every flush_interval seconds, the counts of recorded stacks are
+    written to a new file in directory and reset.
+    """
+
+    def __init__(self, directory, filenames=(), functions=(), interval=0.1,
+                 flush_interval=60):
+        threading.Thread.__init__(self, name='SamplingProfiler')
+        self.daemon = True
+        self.directory = directory
+        self.filenames = set(filenames)
+        self.functions = set(functions)
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.counts = defaultdict(int)
+        self._done = threading.Event()
+
+    def _selected(self, code):
+        return (code.co_name in self.functions or
+                os.path.basename(code.co_filename) in self.filenames)
+
+    def sample(self):
+        """Record the current stacks of other threads."""
+        own = threading.current_thread().ident
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack, selected = [], False
+            while frame is not None:
+                code = frame.f_code
+                selected = selected or self._selected(code)
+                stack.append('%s:%s' % (os.path.basename(code.co_filename),
+                                        code.co_name))
+                frame = frame.f_back
+            if selected:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def flush(self):
+        """Write recorded stacks to a new file and reset counts."""
+        counts, self.counts = self.counts, defaultdict(int)
+        if not counts:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        name = 'stacks-%d-%s.txt' % (os.getpid(),
+                                     time.strftime('%Y%m%d-%H%M%S'))
+        with open(os.path.join(self.directory, name), 'w') as f:
+            for stack, count in sorted(counts.items()):
+                f.write('%s %d\n' % (stack, count))
+
+    def run(self):
+        flushed = time.time()
+        while not self._done.wait(self.interval):
+            self.sample()
+            if time.time() - flushed >= self.flush_interval:
+                self.flush()
+                flushed = time.time()
+        self.flush()
+
+    def stop(self):
+        self._done.set()
+
+class _TracemallocMeter(object):
+    """Python allocations traced by tracemalloc (Python 3.9+)."""
+
+    name = 'tracemalloc'
+
+    @staticmethod
+    def available():
+        return tracemalloc is not None and hasattr(tracemalloc, 'reset_peak')
+
+    def start(self, frames):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def read(self):
+        """Return current and peak bytes since the last reset."""
+        return tracemalloc.get_traced_memory()
+
+    def reset_peak(self):
+        tracemalloc.reset_peak()
+
+class _ProcMeter(object):
+    """Resident set size and its peak from /proc (Linux). The peak is
+    reset through /proc/self/clear_refs (Linux 4.0+)."""
+
+    name = 'rss'
+
+    STATUS = '/proc/self/status'
+    CLEAR_REFS = '/proc/self/clear_refs'
+
+    @classmethod
+    def available(cls):
+        # Checked without writing to clear_refs, which resets the peak.
+        if not os.access(cls.CLEAR_REFS, os.W_OK):
+            return False
+        release = re.match(r'(\d+)\.(\d+)', os.uname()[2])
+        if release is None or tuple(map(int, release.groups())) < (4, 0):
+            return False
+        try:
+            cls().read()
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+        return True
+
+    def start(self, frames):
+        pass
+
+    def read(self):
+        values = {}
+        with open(self.STATUS) as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    key, value = line.split(':', 1)
+                    values[key] = int(value.split()[0]) * 1024
+        return values['VmRSS'], values['VmHWM']
+
+    def reset_peak(self):
+        with open(self.CLEAR_REFS, 'w') as f:
+            f.write('5')
+
+class _RusageMeter(object):
+    """Peak resident set size from getrusage(). As the peak can't be
+    reset, stage peaks are the growth of the process peak within the
+    stage, zero for stages that stay below an earlier peak."""
+
+    name = 'maxrss'
+
+    @staticmethod
+    def available():
+        return resource is not None
+
+    def start(self, frames):
+        pass
+
+    def read(self):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            peak *= 1024 # kilobytes except on macOS
+        return peak, peak
+
+    def reset_peak(self):
+        pass
+
+# Ways of measuring memory, most precise first.
+MEMORY_METERS = [_TracemallocMeter, _ProcMeter, _RusageMeter]
+
+class StageMemory(object):
+    """Accounting of peak memory used in stages of processing.
+
+    When enabled, stage() records the peak memory above the level at
+    the start of each stage, nested stages included. Memory is
+    measured as allocations traced by tracemalloc if available, and
+    otherwise as the resident set size of the process; see
+    MEMORY_METERS. Peaks are recorded by stage for the current request
+    of each thread (see start_request()) and in totals.
+
+    Memory and its peak are process-wide. A stage resets the peak only
+    if no other thread is in a stage, so that peaks are exact when one
+    thread at a time is measured (e.g. single-threaded workers). When
+    stages of several threads overlap, peaks are never too low but may
+    include memory used by the other stages.
+    """
+
+    def __init__(self, recent=20):
+        self.enabled = False
+        self.meter = None
+        self.totals = {}
+        self.recent = deque(maxlen=recent)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Number of threads in a stage, guarded by _meter_lock.
+        self._measuring = 0
+        self._meter_lock = threading.Lock()
+
+    @staticmethod
+    def available():
+        return any(m.available() for m in MEMORY_METERS)
+
+    def enable(self, frames=1):
+        """Start measuring with the most precise available meter.
+        Raises RuntimeError if none is available."""
+        for meter in MEMORY_METERS:
+            if meter.available():
+                break
+        else:
+            raise RuntimeError('no way to measure memory available')
+        self.meter = meter()
+        self.meter.start(frames)
+        self.enabled = True
+
+    def start_request(self):
+        """Start recording peaks of a new request in this thread."""
+        self._local.request = OrderedDict()
+
+    def finish_request(self, label):
+        """Return peaks recorded for the request of this thread by
+        stage, keeping them with label among the recent requests."""
+        peaks = getattr(self._local, 'request', None)
+        self._local.request = None
+        if peaks:
+            with self._lock:
+                self.recent.append((label, peaks))
+        return peaks
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager recording peak memory used within."""
+        if not self.enabled:
+            yield
+            return
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        meter = self.meter
+        with self._meter_lock:
+            if not stack:
+                self._measuring += 1
+            current, peak = meter.read()
+            if self._measuring == 1:
+                # The peak is reset below, so note it for the enclosing
+                # stage.
+                if stack:
+                    stack[-1][1] = max(stack[-1][1], peak)
+                meter.reset_peak()
+        entry = [current, current] # start, peak before nested stages
+        stack.append(entry)
+        try:
+            yield
+        finally:
+            stack.pop()
+            with self._meter_lock:
+                peak = max(entry[1], meter.read()[1])
+                if not stack:
+                    self._measuring -= 1
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+            self._record(name, peak - entry[0])
+
+    def _record(self, name, peak):
+        request = getattr(self._local, 'request', None)
+        if request is not None:
+            request[name] = max(request.get(name, 0), peak)
+        with self._lock:
+            count, maximum, total = self.totals.get(name, (0, 0, 0))
+            self.totals[name] = (count+1, max(maximum, peak), total+peak)
+
+    def stats(self):
+        """Return dict with peak bytes by stage in total and for recent
+        requests."""
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'method': self.meter.name if self.meter else None,
+                'stages': {
+                    name: { 'count': c, 'max_peak': m, 'mean_peak': t // c }
+                    for name, (c, m, t) in self.totals.items()
+                },
+                'recent': [{ 'request': label, 'peaks': dict(peaks) }
+                           for label, peaks in self.recent],
+            }
+
+# Memory accounting of this process, disabled until enabled.
+memory = StageMemory()
+
+def memory_stage(name):
+    """Context manager recording peak memory of stage with given name
+    if memory accounting is enabled."""
+    return memory.stage(name)
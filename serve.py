@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""Production server for the RESTful Open Annotation explorer.
+
+Runs the explorer in preforked worker processes using gunicorn
+(http://gunicorn.org/), which must be installed separately. Workers
+are threaded by default so that each can wait on several upstream
+requests at once, and are recycled after a number of requests to
+bound memory growth. Send SIGHUP to the master process to restart the
+workers gracefully; as the application is imported before the master
+starts, code changes take effect only when the server is restarted.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import multiprocessing
+
+# Defaults for serve()
+DEFAULT_THREADS = 8
+DEFAULT_MAX_REQUESTS = 1000
+DEFAULT_TIMEOUT = 120
+
+def default_workers():
+    """Return default number of worker processes for this machine."""
+    return multiprocessing.cpu_count() * 2 + 1
+
+def serve(app, host='0.0.0.0', port=7000, workers=None, threads=None,
+          worker_class='gthread', max_requests=DEFAULT_MAX_REQUESTS,
+          timeout=DEFAULT_TIMEOUT, warm_up=None):
+    """Serve WSGI application app until terminated.
+
+    If warm_up is not None, it is called without arguments in each
+    worker process before it starts accepting requests.
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise ImportError('production serving requires gunicorn')
+
+    if workers is None:
+        workers = default_workers()
+    if threads is None:
+        threads = DEFAULT_THREADS
+
+    options = {
+        'bind': '%s:%d' % (host, port),
+        'workers': workers,
+        'worker_class': worker_class,
+        'threads': threads,
+        # Recycle workers after max_requests, with jitter to avoid
+        # restarting all of them at once.
+        'max_requests': max_requests,
+        'max_requests_jitter': max(1, max_requests // 10),
+        'timeout': timeout,
+        'graceful_timeout': timeout,
+        # The application is imported by the caller before the master
+        # starts, so workers share its code either way and SIGHUP
+        # doesn't reload it.
+        'preload_app': False,
+    }
+    if warm_up is not None:
+        options['post_worker_init'] = lambda worker: warm_up()
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Server().run()
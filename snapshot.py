@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""Cache snapshots for the RESTful Open Annotation explorer.
+
+In-memory caches are periodically saved to local files so that
+restarted processes can start with warm caches. Each process saves
+to its own file, and the files of all processes are merged when
+loading. Snapshots are pickled for fast loading; as pickles can
+execute code when loaded, the snapshot directory must only be
+writable by the explorer.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import os
+import time
+import atexit
+import logging
+import tempfile
+import threading
+import cPickle as pickle
+
+# Version of the snapshot contents. Snapshots of other versions are
+# ignored.
+VERSION = 4
+
+class Snapshot(object):
+    """Snapshot of a dict of cache contents, saved by each process to
+    the file path.PID so that processes sharing a path (e.g. server
+    workers) don't overwrite each other's caches.
+
+    Loading merges the files of all processes, oldest first: dict
+    values are updated and list values extended. Files are only read
+    on the first call to load(). Files of other processes that have
+    not been saved for max_age seconds (e.g. of exited workers) are
+    removed when saving.
+    """
+
+    def __init__(self, path, max_age=None):
+        self.path = path
+        self.max_age = max_age
+        self._data = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Return dict stored in snapshot, or an empty dict if there is
+        no usable snapshot. The dict is shared between callers."""
+        with self._lock:
+            if self._data is None:
+                self._data = {}
+                for path in self._files():
+                    _merge(self._data, self._read(path))
+            return self._data
+
+    def _files(self):
+        """Return snapshot files of all processes, oldest first."""
+        directory, name = os.path.split(os.path.abspath(self.path))
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return []
+        files = []
+        for n in names:
+            prefix, dot, pid = n.rpartition('.')
+            if prefix != name or not pid.isdigit():
+                continue
+            path = os.path.join(directory, n)
+            try:
+                files.append((os.path.getmtime(path), path))
+            except OSError:
+                pass # removed by another process
+        return [path for mtime, path in sorted(files)]
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+        except IOError:
+            return {}
+        except Exception, e:
+            logging.getLogger(__name__).warning(
+                'ignoring snapshot %s: %s' % (path, str(e)))
+            return {}
+        if not isinstance(data, dict) or data.get('version') != VERSION:
+            return {}
+        return data
+
+    def save(self, data):
+        """Store dict in the snapshot file of this process."""
+        data = dict(data, version=VERSION)
+        path = '%s.%d' % (self.path, os.getpid())
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Write via temporary file and rename so that readers (e.g.
+        # other processes starting up) never see partial files.
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+        if self.max_age is not None:
+            self._remove_stale()
+
+    def _remove_stale(self):
+        cutoff = time.time() - self.max_age
+        for path in self._files():
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass # removed by another process
+
+def _merge(merged, data):
+    """Merge snapshot contents data into merged."""
+    for key, value in data.iteritems():
+        if isinstance(value, dict):
+            merged.setdefault(key, {}).update(value)
+        elif isinstance(value, list):
+            merged.setdefault(key, []).extend(value)
+        else:
+            merged[key] = value
+
+class SnapshotWriter(threading.Thread):
+    """Background thread saving the dict returned by contents() to a
+    Snapshot every interval seconds and at exit."""
+
+    def __init__(self, snapshot, contents, interval=300):
+        threading.Thread.__init__(self, name='SnapshotWriter')
+        self.daemon = True
+        self.snapshot = snapshot
+        self.contents = contents
+        self.interval = interval
+        self._done = threading.Event()
+        atexit.register(self.stop)
+
+    def write(self):
+        started = time.time()
+        try:
+            self.snapshot.save(self.contents())
+        except Exception, e:
+            logging.getLogger(__name__).warning(
+                'failed to write snapshot %s: %s' % (self.snapshot.path,
+                                                     str(e)))
+            return
+        logging.getLogger(__name__).info(
+            'wrote snapshot %s in %.1fs' % (self.snapshot.path,
+                                            time.time()-started))
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        if not self._done.is_set():
+            self._done.set()
+            self.write()
@@ -8,11 +8,28 @@ __license__ = 'MIT'
 import sys
 import json
 import re
+import time
+import heapq
+import hashlib
+import threading
 import unicodedata
 
 from collections import namedtuple
 from collections import defaultdict
+from collections import OrderedDict
 from itertools import chain
+from bisect import bisect_right
+
+import spanfile
+
+try:
+    from profiling import memory_stage
+except ImportError:
+    # Standalone use, without memory accounting.
+    from contextlib import contextmanager
+    @contextmanager
+    def memory_stage(name):
+        yield
 
 # the tag to use to mark annotated spans
 TAG='span'
@@ -34,15 +51,21 @@ class Span(object):
     are rendered as text highligts, the latter as HTML formatting tags
     such as <i> and <p>.
     """
-    def __init__(self, start, end, type_, formatting=None):
+    def __init__(self, start, end, type_, formatting=None, count=1,
+                 types=None):
         """Initialize annotation or formatting span.
 
         If formatting is None, determine whether or not this is a
-        formatting tag heuristically based on type_.
+        formatting tag heuristically based on type_. count is the
+        number of identical annotations the span stands for, and types
+        an optional list of (type, count) pairs for spans merged from
+        annotations of several types.
         """
         self.start = start
         self.end = end
         self.type = type_
+        self.count = count
+        self.types = types if types is not None else [(type_, count)]
         if formatting is not None:
             self.formatting = formatting
         else:
@@ -56,6 +79,11 @@ class Span(object):
         # generate link (<a> tag) with given href if not None
         self.href = None
 
+        # (coarse type, hint) pair for compact markup, None for full
+        # markup (see standoff_to_html()). Compact markup refers to
+        # them through _PageId slots (see _render_spans()).
+        self.ids = None
+
     def tag(self):
         """Return HTML tag to use to render this marker."""
         # Formatting tags render into HTML tags according to a custom
@@ -71,6 +99,11 @@ class Span(object):
         else:
             return type_to_formatting_tag(self.type)
 
+    def hint(self):
+        """Return tooltip text for this span."""
+        return ', '.join(t if c == 1 else '%s (x%d)' % (t, c)
+                         for t, c in self.types)
+
     def markup_type(self):
         """Return a coarse variant of the type that can be used as a label in
         HTML markup (tag, CSS class name, etc)."""
@@ -119,6 +152,42 @@ FORMATTING_TYPE_TAG_MAP = {
     'http://craft.ucdenver.edu/iao/sup': 'sup',
 }
 
+# Standoff standing for count identical annotations, optionally of
+# several types given as (type, count) pairs.
+CollapsedStandoff = namedtuple('CollapsedStandoff',
+                               'start end type count types')
+
+def collapse_standoffs(standoffs, merge_types=False):
+    """Merge standoffs with identical (start, end, type) into one
+    CollapsedStandoff carrying their count.
+
+    If merge_types is True, also merge standoffs of different types
+    with identical extents into one, with the type of the first. Order
+    of first occurrence is preserved.
+    """
+    grouped = OrderedDict()
+    for so in standoffs:
+        if not merge_types:
+            key = (so.start, so.end, so.type)
+        else:
+            # formatting types render as tags and are kept separate
+            key = (so.start, so.end, is_formatting_type(so.type) and so.type)
+        counts = grouped.get(key)
+        if counts is None:
+            counts = grouped[key] = OrderedDict()
+        if isinstance(so, CollapsedStandoff):
+            type_counts = so.types
+        else:
+            type_counts = [(so.type, 1)]
+        for type_, count in type_counts:
+            counts[type_] = counts.get(type_, 0) + count
+    collapsed = []
+    for (start, end, _), counts in grouped.iteritems():
+        types = counts.items()
+        collapsed.append(CollapsedStandoff(start, end, types[0][0],
+                                           sum(counts.values()), types))
+    return collapsed
+
 def is_formatting_type(type_):
     """Return True if the given type can be assumed to identify a
     formatting tag such as bold or italic, False otherwise."""
@@ -162,7 +231,21 @@ class Marker(object):
     def attribute_string(self):
         return ' '.join('%s="%s"' % (k, v) for k, v in self.get_attributes())
 
+    def attribute_chunks(self):
+        """Return attributes as list of strings and _PageId slots."""
+        chunks = []
+        for name in sorted(self._attributes):
+            chunks.append('%s="' % name if not chunks else ' %s="' % name)
+            for i, value in enumerate(self._attributes[name]):
+                if i:
+                    chunks.append(' ')
+                chunks.append(value)
+            chunks.append('"')
+        return chunks
+
     def fill_style_attributes(self):
+        if self.span.ids is not None:
+            return self.fill_compact_style_attributes()
         self.add_attribute('class', 'ann')
         self.add_attribute('class', 'ann-h%d' % self.span.height())
         self.add_attribute('class', 'ann-t%s' % self.span.markup_type())
@@ -177,6 +260,20 @@ class Marker(object):
         if self.covered_right:
             self.add_attribute('class', 'ann-openright')
 
+    def fill_compact_style_attributes(self):
+        """Add short equivalents of the classes added by
+        fill_style_attributes() (see COMPACT_CLASS_NAMES)."""
+        self.add_attribute('class', COMPACT_CLASS_NAMES['ann'])
+        self.add_attribute('class', 'h%d' % self.span.height())
+        self.add_attribute('class', _PageId('t', self.span.ids[0]))
+        # Note: "ann-conright" has no style and is left out.
+        if self.cont_left:
+            self.add_attribute('class', COMPACT_CLASS_NAMES['ann-contleft'])
+        if self.covered_left:
+            self.add_attribute('class', COMPACT_CLASS_NAMES['ann-openleft'])
+        if self.covered_right:
+            self.add_attribute('class', COMPACT_CLASS_NAMES['ann-openright'])
+
     def __unicode__(self):
         if self.is_end:
             return u'</%s>' % self.span.tag()
@@ -188,6 +285,14 @@ class Marker(object):
             attributes = self.attribute_string()
             return u'<%s %s>' % (self.span.tag(), attributes)
 
+    def chunks(self):
+        """Return markup as list of strings and _PageId slots."""
+        if self.is_end or self.span.formatting or self.span.ids is None:
+            return [unicode(self)]
+        self.fill_style_attributes()
+        return ([u'<%s ' % self.span.tag()] + self.attribute_chunks() +
+                [u'>'])
+
 def marker_sort(a, b):
     return cmp(a.offset, b.offset) or cmp(a.sort_idx, b.sort_idx)
 
@@ -289,6 +394,28 @@ BASE_CSS=""".ann {
   border-bottom-left-radius: 0;
 }"""
 
+# Short class names used in compact markup in place of the class names
+# of BASE_CSS. Height and type classes ann-hN and ann-tTYPE are
+# shortened to hN and tID, where ID indexes a per-page type table.
+COMPACT_CLASS_NAMES = {
+    'ann': 'a',
+    'ann-openright': 'or',
+    'ann-openleft': 'ol',
+    'ann-contright': 'cr',
+    'ann-contleft': 'cl',
+}
+
+def _compact_class_names(css):
+    """Replace class names in CSS with their compact equivalents."""
+    return re.sub(r'\.(ann[-\w]*)',
+                  lambda m: '.' + COMPACT_CLASS_NAMES[m.group(1)], css)
+
+def css_string(s):
+    """Return given string as a quoted CSS string."""
+    s = s.replace('\\', '\\\\').replace('"', '\\"')
+    # Avoid terminating the style element and literal newlines
+    return '"%s"' % s.replace('<', '\\3C ').replace('\n', '\\A ')
+
 def line_height_css(height):
     if height == 0:
         return ''
@@ -311,17 +438,50 @@ def generate_css(max_height, color_map, legend):
 }""" % (html_safe_string(t), c, darker_color(c)))
     return '\n'.join(css)
 
+def generate_compact_css(max_height, coarse_types, color_map, hints, legend):
+    """Generate CSS for compact markup, where height, type and hint
+    classes are identified by their indices in coarse_types and hints.
+
+    The resulting page looks identical to one using generate_css().
+    """
+    css = [LEGEND_CSS] if legend else []
+    css.append(_compact_class_names(BASE_CSS))
+    css.append("""a.%s {
+  text-decoration: none;
+  color: inherit;
+}""" % COMPACT_CLASS_NAMES['ann'])
+    for i in range(max_height+1):
+        css.append(""".h%d {
+  padding-top: %dpx;
+  padding-bottom: %dpx;
+  %s
+}""" % (i, i*VSPACE, i*VSPACE, line_height_css(i)))
+    for i, t in enumerate(coarse_types):
+        c = color_map[t]
+        css.append(""".t%d {
+  background-color: %s;
+  border-color: %s;
+}""" % (i, c, darker_color(c)))
+    # Tooltip texts, replacing the data-hint attributes read by
+    # hint.css.
+    for i, h in enumerate(hints):
+        css.append('.i%d:after { content: %s; }' % (i, css_string(h)))
+    return '\n'.join(css)
+
 def uniq(s):
     """Return unique items in given sequence, preserving order."""
     # http://stackoverflow.com/a/480227
     seen = set()
     return [ i for i in s if i not in seen and not seen.add(i)]
 
-def generate_legend(types, colors):
+def generate_legend(types, colors, compact=False):
     parts = ['''<div class="legend">Legend<table>''']
-    for f, c in zip(types, colors):
-        t = html_safe_string(f)
-        tagl, tagr = '<%s class="ann ann-t%s">' % (TAG, t), '</%s>' % TAG
+    for i, (f, c) in enumerate(zip(types, colors)):
+        if not compact:
+            classes = 'ann ann-t%s' % html_safe_string(f)
+        else:
+            classes = '%s t%d' % (COMPACT_CLASS_NAMES['ann'], i)
+        tagl, tagr = '<%s class="%s">' % (TAG, classes), '</%s>' % TAG
         parts.append('<tr><td>%s%s%s</td></tr>' % (tagl, f, tagr))
     parts.append('</table></div>')
     return ''.join(parts)
@@ -409,11 +569,18 @@ def _filter_empty_spans(spans):
             filtered.append(span)
     return filtered
 
-def _standoff_to_html(text, standoffs, legend, tooltips, links):
-    """standoff_to_html() implementation, don't invoke directly."""
+def _standoff_to_span(so):
+    if isinstance(so, CollapsedStandoff):
+        return Span(so.start, so.end, so.type, count=so.count, types=so.types)
+    else:
+        return Span(so.start, so.end, so.type)
+
+def _prepare_spans(text, standoffs, legend, compact=False):
+    """Return spans, coarse types, color map and legend HTML for given
+    text and standoffs."""
 
     # Convert standoffs to Span objects.
-    spans = [Span(so.start, so.end, so.type) for so in standoffs]
+    spans = [_standoff_to_span(so) for so in standoffs]
 
     # Add formatting such as paragraph breaks if none are provided.
     spans = _add_formatting_spans(spans, text)
@@ -440,14 +607,343 @@ def _standoff_to_html(text, standoffs, legend, tooltips, links):
 #         full_forms = uniq(so.type for so in standoffs)
 #         type_to_full_form = { html_safe_string(f) : f for f in full_forms }
 #         legend_types = [ type_to_full_form[t] for t in types ]
-        legend_html = generate_legend(coarse_types, colors)
+        legend_html = generate_legend(coarse_types, colors, compact)
 
-    # resolve height of each span by determining span nesting
-    max_height = resolve_heights(spans)
+    return spans, coarse_types, color_map, legend_html
+
+def _standoff_to_html(text, standoffs, legend, tooltips, links,
+                      processes=None, cache=None, compact=False,
+                      budget=None):
+    """standoff_to_html() implementation, don't invoke directly.
+
+    Returns CSS, body HTML and the rendering mode used.
+    """
+
+    started = time.time()
+    mode = FULL
+    if budget is not None:
+        mode, standoffs = _select_render_mode(text, standoffs, budget)
+
+    with memory_stage('render.prepare'):
+        spans, coarse_types, color_map, legend_html = _prepare_spans(
+            text, standoffs, legend, compact)
+
+    # For compact markup, identify coarse types and hints by their
+    # indices in per-page tables. Spans carry the type and hint
+    # strings, which are mapped to page indices when joining the
+    # rendered partitions so that these don't depend on the rest of
+    # the page.
+    coarse_ids, hint_ids = {}, {}
+    if compact:
+        coarse_ids = { t: i for i, t in enumerate(coarse_types) }
+        hints = uniq(s.hint() for s in spans if not s.formatting)
+        hint_ids = { h: i for i, h in enumerate(hints) }
+        for s in (s for s in spans if not s.formatting):
+            s.ids = (coarse_type(s.type), s.hint())
+
+    if mode == FLAT:
+        spans = flatten_spans(spans)
+
+    # Split the document at offsets that no span crosses and render
+    # each partition separately, in parallel if requested. Spans in
+    # different partitions cannot nest, so heights and markup are
+    # identical to rendering the document as a whole. Partitions found
+    # in the cache are not re-rendered.
+    partitions = partition_spans(spans, len(text))
+    jobs = [
+        (text[start:end], [_span_to_tuple(s, start) for s in part],
+         tooltips, links)
+        for start, end, part in partitions
+    ]
+    if cache is None:
+        keys, results = None, [None] * len(jobs)
+    else:
+        keys = [_partition_key(job) for job in jobs]
+        results = [cache.get(key) for key in keys]
+    with memory_stage('render.markup'):
+        missing = [i for i, r in enumerate(results) if r is None]
+        parallel = processes is not None and processes > 1 and len(missing) > 1
+        # With a budget, render in rounds of one partition per process
+        # so that the deadline can be checked between rounds.
+        if budget is None:
+            step = len(missing) or 1
+        else:
+            step = processes if parallel else 1
+        for first in range(0, len(missing), step):
+            batch = missing[first:first+step]
+            # If over budget despite predictions, render the remaining
+            # partitions flat. Flat partitions are cached under keys of
+            # their own, not those of the full renderings.
+            if (budget is not None and mode != FLAT and
+                time.time() - started > budget):
+                mode = PARTIAL
+                for i in batch:
+                    jobs[i] = _flatten_job(jobs[i])
+                    if cache is not None:
+                        keys[i] = _partition_key(jobs[i])
+            if parallel:
+                rendered = _get_pool(processes).map(_render_partition,
+                                                    [jobs[i] for i in batch])
+            else:
+                rendered = [_render_partition(jobs[i]) for i in batch]
+            for i, result in zip(batch, rendered):
+                results[i] = result
+                if cache is not None:
+                    cache.set(keys[i], result)
+    max_height = max([r[0] for r in results] + [-1])
 
     # Generate CSS as combination of boilerplate and height-specific
     # styles up to the required maximum height.
-    css = generate_css(max_height, color_map, legend)
+    if not compact:
+        css = generate_css(max_height, color_map, legend)
+    else:
+        css = generate_compact_css(max_height, coarse_types, color_map,
+                                   hints, legend)
+
+    with memory_stage('render.join'):
+        body = legend_html + u''.join(
+            _page_markup(chunks, coarse_ids, hint_ids)
+            for _, chunks in results)
+    if mode != FULL:
+        body = _degraded_notice_html(mode) + body
+    _count_render_mode(mode)
+    return css, body, mode
+
+# Rendering modes, in order of decreasing fidelity. FULL renders all
+# spans with nesting, TOP_TYPES only spans of the most frequent types,
+# PARTIAL switches to FLAT midway, and FLAT renders non-overlapping
+# highlights without nesting (see flatten_spans()).
+FULL = 'full'
+TOP_TYPES = 'top-types'
+PARTIAL = 'partial'
+FLAT = 'flat'
+
+# Number of types rendered in TOP_TYPES mode.
+TOP_TYPE_COUNT = 10
+
+# Rendering time per span and per pair of overlapping spans (see
+# render_time_factors()), used to predict whether rendering fits a
+# budget. Fitted by benchmarks/render_time.py on one core of an Intel
+# Xeon server with Python 2.7.18, predicting 1,000 to 16,000 span
+# documents within 25%. Recalibrate on slower machines.
+SECONDS_PER_SPAN = 0.000095
+SECONDS_PER_OVERLAP = 0.0000047
+
+# Number of renderings in each mode.
+render_mode_counts = defaultdict(int)
+_render_mode_lock = threading.Lock()
+
+def _count_render_mode(mode):
+    with _render_mode_lock:
+        render_mode_counts[mode] += 1
+
+def render_time_factors(text, standoffs):
+    """Return (spans, overlaps) for given text and standoffs, the
+    factors of the rendering time estimated by predict_render_time()."""
+    # Nested spans make resolve_heights() cost grow with the square of
+    # the number of open spans; other work is roughly linear.
+    open_ends, overlaps = [], 0
+    for so in sorted(standoffs, key=lambda so: so.start):
+        while open_ends and open_ends[0] <= so.start:
+            heapq.heappop(open_ends)
+        heapq.heappush(open_ends, so.end)
+        overlaps += len(open_ends) ** 2
+    spans = len(standoffs) + text.count('\n') + 1 # + sections
+    return spans, overlaps
+
+def predict_render_time(text, standoffs):
+    """Return rough estimate of the time in seconds that rendering given
+    text and standoffs takes."""
+    spans, overlaps = render_time_factors(text, standoffs)
+    return spans * SECONDS_PER_SPAN + overlaps * SECONDS_PER_OVERLAP
+
+def _select_render_mode(text, standoffs, budget):
+    """Return rendering mode predicted to fit the budget and the
+    standoffs to render in it."""
+    if predict_render_time(text, standoffs) <= budget:
+        return FULL, standoffs
+    counts = defaultdict(int)
+    for so in standoffs:
+        counts[so.type] += so.count if isinstance(so, CollapsedStandoff) else 1
+    if len(counts) > TOP_TYPE_COUNT:
+        top = set(sorted(counts, key=lambda t: -counts[t])[:TOP_TYPE_COUNT])
+        filtered = [so for so in standoffs if so.type in top]
+        if predict_render_time(text, filtered) <= budget:
+            return TOP_TYPES, filtered
+    return FLAT, standoffs
+
+def flatten_spans(spans):
+    """Return non-overlapping spans highlighting the same text as the
+    given ones.
+
+    Each part of the text is covered by a copy of the shortest span
+    covering it. Formatting spans are kept as is.
+    """
+    formatting = [s for s in spans if s.formatting]
+    starts = defaultdict(list)
+    for s in spans:
+        if not s.formatting:
+            starts[s.start].append(s)
+    # Also cut at formatting boundaries so that flat spans nest in
+    # formatting ones.
+    formatting_offsets = set()
+    for s in formatting:
+        formatting_offsets.update((s.start, s.end))
+    offsets = sorted(formatting_offsets.union(
+        chain.from_iterable((s.start, s.end) for s in spans)))
+
+    active, segments = [], []
+    for start, end in zip(offsets, offsets[1:]):
+        active = [s for s in active if s.end > start] + starts.get(start, [])
+        if not active:
+            continue
+        top = min(active, key=lambda s: s.end-s.start)
+        if (segments and segments[-1][0] is top and
+            segments[-1][2] == start and start not in formatting_offsets):
+            segments[-1][2] = end
+        else:
+            segments.append([top, start, end])
+
+    flat = []
+    for top, start, end in segments:
+        span = Span(start, end, top.type, top.formatting, top.count,
+                    top.types)
+        span.ids = top.ids
+        flat.append(span)
+    return flat + formatting
+
+def _flatten_job(job):
+    """Return variant of _render_partition() job with flattened spans."""
+    text, span_tuples, tooltips, links = job
+    spans = []
+    for start, end, type_, formatting, count, types, ids in span_tuples:
+        span = Span(start, end, type_, formatting, count, types)
+        span.ids = ids
+        spans.append(span)
+    spans = flatten_spans(spans)
+    return (text, [_span_to_tuple(s) for s in spans], tooltips, links)
+
+DEGRADED_NOTICE_CSS = """.degraded {
+  margin: 5px;
+  padding: 5px;
+  border: 1px solid #e0c080;
+  background-color: #fff8e0;
+  font-family: sans-serif;
+  font-size: 90%;
+}"""
+
+_degraded_notice_text = {
+    TOP_TYPES: 'only the %d most frequent types are shown' % TOP_TYPE_COUNT,
+    PARTIAL: 'part of the document is shown without nesting',
+    FLAT: 'annotations are shown without nesting',
+}
+
+def _degraded_notice_html(mode):
+    return ('<div class="degraded" data-render-mode="%s">Simplified '
+            'rendering: %s.</div>' % (mode, _degraded_notice_text[mode]))
+
+# Approximate length of text in characters for a partition rendered
+# separately by _standoff_to_html().
+PARTITION_SIZE = 4096
+
+def partition_spans(spans, length, size=PARTITION_SIZE):
+    """Partition spans into groups that can be rendered independently.
+
+    Return list of (start, end, spans) triples where start and end
+    give a range of text and spans contains the spans within it in
+    their original order. No span crosses a partition boundary.
+    """
+    # Cut at the first offset in each size-character block of text
+    # that no span crosses. As cuts don't depend on the length of
+    # preceding partitions, changes to spans only move nearby cuts,
+    # which keeps the remaining partitions (and their cache keys)
+    # stable.
+    cuts, reach = [0], 0
+    for s in sorted(spans, key=lambda s: s.start):
+        # All spans seen so far end at or before s.start if reach
+        # does not exceed it.
+        if s.start >= reach and s.start // size > cuts[-1] // size:
+            cuts.append(s.start)
+        reach = max(reach, s.end)
+    cuts.append(max(length, reach))
+    parts = [[] for _ in range(len(cuts)-1)]
+    for s in spans:
+        parts[bisect_right(cuts, s.start)-1].append(s)
+    return [(cuts[i], cuts[i+1], parts[i]) for i in range(len(parts))]
+
+def _span_to_tuple(span, offset=0):
+    return (span.start-offset, span.end-offset, span.type, span.formatting,
+            span.count, span.types, span.ids)
+
+def _partition_key(job):
+    """Return render cache key for _render_partition() job."""
+    text, span_tuples, tooltips, links = job
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    text_digest = hashlib.sha1(text).hexdigest()
+    spans_digest = hashlib.sha1(repr(span_tuples)).hexdigest()
+    return (text_digest, spans_digest, tooltips, links)
+
+def _render_partition(job):
+    """Render (text, span tuples, tooltips, links) job, returning
+    (max height, markup chunks). Top-level function for process pool
+    use.
+
+    For compact markup, span tuples carry (coarse type, hint) pairs,
+    and the markup refers to them through _PageId slots (see
+    _render_spans()). The result depends only on the job, so it can
+    be cached across pages.
+    """
+    text, span_tuples, tooltips, links = job
+    spans = []
+    for start, end, type_, formatting, count, types, ids in span_tuples:
+        span = Span(start, end, type_, formatting, count, types)
+        span.ids = ids
+        spans.append(span)
+    max_height = resolve_heights(spans)
+    return max_height, _render_spans(text, spans, tooltips, links)
+
+# Slot in compact markup for the page-wide class name of a coarse type
+# (kind 't') or hint (kind 'i') given by key.
+_PageId = namedtuple('_PageId', 'kind key')
+
+def _page_markup(chunks, coarse_ids, hint_ids):
+    """Return markup for chunks from _render_spans(), with _PageId
+    slots replaced by class names for ids in the page tables
+    coarse_ids and hint_ids."""
+    tables = { 't': coarse_ids, 'i': hint_ids }
+    return u''.join(
+        u'%s%d' % (c.kind, tables[c.kind][c.key])
+        if isinstance(c, _PageId) else c for c in chunks)
+
+# Process pools for parallel rendering, keyed by number of processes.
+_pools = {}
+_pools_lock = threading.Lock()
+
+def start_pool(processes):
+    """Create the pool of given number of processes for parallel
+    rendering if it doesn't exist yet.
+
+    Threaded servers should call this before starting to serve, as
+    forking while other threads hold locks can leave the pool
+    processes with locks that are never released.
+    """
+    with _pools_lock:
+        if processes not in _pools:
+            import multiprocessing
+            _pools[processes] = multiprocessing.Pool(processes)
+        return _pools[processes]
+
+def _get_pool(processes):
+    pool = _pools.get(processes)
+    if pool is None:
+        pool = start_pool(processes)
+    return pool
+
+def _render_spans(text, spans, tooltips, links):
+    """Return HTML for text with spans of resolved heights as list of
+    chunks: strings, and for compact markup, _PageId slots for class
+    names that depend on the page (see _page_markup())."""
 
     # Decompose into separate start and end markers for conversion
     # into tags.
@@ -471,7 +967,7 @@ def _standoff_to_html(text, standoffs, legend, tooltips, links):
         to_open, to_close = [], []
         max_change_height = -1
         last = None
-        for j in range(i, len(markers)):
+        for j in xrange(i, len(markers)):
             if markers[j].offset != o:
                 break
             if markers[j].is_end:
@@ -518,15 +1014,17 @@ def _standoff_to_html(text, standoffs, legend, tooltips, links):
         i = last+1
     out.append(text[o:])
 
-    if legend_html:
-        out = [legend_html] + out
-
     # add in attributes to trigger tooltip display
     if tooltips:
         for m in (o for o in out if isinstance(o, Marker) and not o.is_end):
             m.add_attribute('class', 'hint--top')
-            # TODO: useful, not renundant info
-            m.add_attribute('data-hint', m.span.type)
+            if m.span.ids is None:
+                # TODO: useful, not renundant info
+                m.add_attribute('data-hint', m.span.hint())
+            else:
+                # hint text from CSS, see generate_compact_css()
+                m.add_attribute('class', 'hint')
+                m.add_attribute('class', _PageId('i', m.span.ids[1]))
 
     # add in links for spans with HTML types if requested
     if links:
@@ -534,10 +1032,80 @@ def _standoff_to_html(text, standoffs, legend, tooltips, links):
             # TODO: better heuristics
             if m.span.type.startswith('http://'):
                 m.span.href = m.span.type
-                m.add_attribute('href', m.span.href)
-                m.add_attribute('target', '_blank')
+                if m.span.ids is None:
+                    m.add_attribute('href', m.span.href)
+                    m.add_attribute('target', '_blank')
+                elif m.span.tag() == 'a':
+                    # Compact markup omits href where it has no effect
+                    # and sets the target for the page in <base>.
+                    m.add_attribute('href', m.span.href)
+
+    # Join text and markup between slots.
+    chunks, run = [], []
+    for o in out:
+        for c in (o.chunks() if isinstance(o, Marker) else (o,)):
+            if isinstance(c, _PageId):
+                chunks.extend((u''.join(run), c))
+                run = []
+            else:
+                run.append(c)
+    chunks.append(u''.join(run))
+    return chunks
+
+def _client_type(span, links):
+    """Return type table entry for client-side rendering of span."""
+    if span.formatting:
+        return { 'tag': span.tag(), 'cls': None, 'href': None }
+    # TODO: better heuristics (see _render_spans())
+    if links and span.type.startswith('http://'):
+        href = span.type
+    else:
+        href = None
+    return { 'tag': None, 'cls': span.markup_type(), 'href': href }
 
-    return css, u''.join(unicode(o) for o in out)
+def _standoff_to_payload(text, standoffs, legend, tooltips, links):
+    """Return CSS, legend HTML and data for rendering given text and
+    standoffs with the client-side renderer static/js/so2html.js.
+
+    Spans are given in columns of offsets, type table indices and
+    resolved heights, and hints as indices into a table of strings.
+    """
+    spans, _, color_map, legend_html = _prepare_spans(text, standoffs, legend)
+
+    max_height = -1
+    for _, _, part in partition_spans(spans, len(text)):
+        max_height = max(max_height, resolve_heights(part))
+    css = generate_css(max_height, color_map, legend)
+
+    type_ids, types, hint_ids, hints = {}, [], {}, []
+    columns = { 'start': [], 'end': [], 'type': [], 'height': [] }
+    if tooltips:
+        columns['hint'] = []
+    for s in spans:
+        key = (s.type, s.formatting)
+        if key not in type_ids:
+            type_ids[key] = len(types)
+            types.append(_client_type(s, links))
+        columns['start'].append(s.start)
+        columns['end'].append(s.end)
+        columns['type'].append(type_ids[key])
+        columns['height'].append(s.height())
+        if tooltips:
+            # formatting tags take no attributes
+            hint = s.hint() if not s.formatting else ''
+            if hint not in hint_ids:
+                hint_ids[hint] = len(hints)
+                hints.append(hint)
+            columns['hint'].append(hint_ids[hint])
+
+    payload = {
+        'text': text,
+        'spans': columns,
+        'types': types,
+        'hints': hints,
+        'tooltips': tooltips,
+    }
+    return css, legend_html, payload
 
 def darker_color(c, amount=0.3):
     """Given HTML-style #RRGGBB color string, return variant that is
@@ -734,20 +1302,82 @@ def _trailer_html():
 </html>"""
 
 def standoff_to_html(text, standoffs, legend=True, tooltips=False,
-                     links=False):
+                     links=False, collapse=True, merge_types=False,
+                     processes=None, cache=None, compact=False,
+                     budget=None, with_mode=False):
     """Create HTML representation of given text and standoff
     annotations.
+
+    If collapse is True, identical standoffs are rendered as a single
+    span (see collapse_standoffs()). If processes is greater than one,
+    independent parts of long documents are rendered in parallel in a
+    pool of that many processes. If cache is given, it is used through
+    get() and set() to store rendered parts of documents so that only
+    parts affected by changes are re-rendered.
+
+    If compact is True, generate smaller markup that uses short class
+    names and per-page tables for type styles, tooltips and link
+    targets instead of repeating them for each span. Compact pages
+    look and behave identically to full ones.
+
+    If budget is given, rendering is simplified when it is predicted
+    to take more than budget seconds, or when it does, by rendering
+    only the most frequent types or rendering annotations without
+    nesting. Simplified pages include a notice, and the modes used
+    are counted in render_mode_counts. If with_mode is True, return
+    (HTML, mode) with the mode used (FULL if not simplified).
     """
-    css, body = _standoff_to_html(text, standoffs, legend, tooltips, links)
+    if collapse:
+        standoffs = collapse_standoffs(standoffs, merge_types)
+
+    css, body, mode = _standoff_to_html(text, standoffs, legend, tooltips,
+                                        links, processes, cache, compact,
+                                        budget)
+    if mode != FULL:
+        css += '\n' + DEGRADED_NOTICE_CSS
 
     # Note: tooltips are not generated by default because their use
     # depends on the external CSS library hint.css and this script
     # aims to be standalone in its basic application.
+    if not tooltips:
+        links_string = ''
+    else:
+        links_string = '<link rel="stylesheet" href="static/css/hint.css">'
+    if links and compact:
+        # Open links in new windows without target on each link.
+        links_string += '\n<base target="_blank">'
+
+    with memory_stage('render.page'):
+        html = _header_html(css, links_string) + body + _trailer_html()
+    return (html, mode) if with_mode else html
+
+def standoff_to_client_html(text, standoffs, legend=True, tooltips=False,
+                            links=False, collapse=True, merge_types=False,
+                            script='static/js/so2html.js'):
+    """Create HTML page that renders given text and standoff
+    annotations in the browser.
+
+    The page includes the text and spans as data for the renderer
+    script, which generates the same markup as standoff_to_html().
+    """
+    if collapse:
+        standoffs = collapse_standoffs(standoffs, merge_types)
+
+    css, legend_html, payload = _standoff_to_payload(text, standoffs, legend,
+                                                     tooltips, links)
+
     if not tooltips:
         links_string = ''
     else:
         links_string = '<link rel="stylesheet" href="static/css/hint.css">'
 
+    # Escape "</" to avoid terminating the script element early.
+    data = json.dumps(payload, separators=(',', ':')).replace('</', '<\\/')
+    body = (legend_html + '<div id="so2html-text"></div>'
+            '<script src="%s"></script>'
+            '<script>so2html.renderInto(document.getElementById('
+            '"so2html-text"), %s);</script>' % (script, data))
+
     return (_header_html(css, links_string) + body +  _trailer_html())
 
 def main(argv=None):
@@ -763,11 +1393,23 @@ def main(argv=None):
     if len(argv) != 3:
         print >> sys.stderr, 'Usage:', argv[0], '[-n] TEXT SOJSON'
         print >> sys.stderr, '  e.g.', argv[0], '\'Bob, UK\' \'[[0,3,"Person"],[5,7,"GPE"]]\''
+        print >> sys.stderr, '  TEXT and SOJSON can be given as @FILE, with SOJSON'
+        print >> sys.stderr, '  either JSON or a span file (see spanfile.py).'
         return 1
 
     text = argv[1]
-    standoffs = json_to_standoffs(argv[2])
-    print standoff_to_html(text, standoffs, legend)
+    if text.startswith('@'):
+        with open(text[1:]) as f:
+            text = f.read()
+    text = text.decode('utf-8')
+    if not argv[2].startswith('@'):
+        standoffs = json_to_standoffs(argv[2])
+    elif spanfile.is_span_file(argv[2][1:]):
+        standoffs = spanfile.read_spans(argv[2][1:])
+    else:
+        with open(argv[2][1:]) as f:
+            standoffs = json_to_standoffs(f.read())
+    print standoff_to_html(text, standoffs, legend).encode('utf-8')
 
     return 0
 
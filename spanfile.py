@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""Compact binary file format for standoff annotations.
+
+Span files store (start, end, type) standoffs in columns, with types
+as indices into a string table, so that large numbers of standoffs
+load without parsing. The layout is (all integers unsigned 32-bit
+little-endian):
+
+    magic      8 bytes, MAGIC
+    count      number of standoffs
+    ntypes     number of types
+    starts     count integers
+    ends       count integers
+    types      count integers, indices into the type table
+    offsets    ntypes+1 integers, byte offsets of types in strings
+    strings    UTF-8 encoded types, concatenated
+
+Files are read through memory mapping.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import os
+import sys
+import mmap
+import struct
+import tempfile
+
+from array import array
+from collections import namedtuple
+
+MAGIC = 'SOSPANS1'
+
+_header = struct.Struct('<8sII')
+
+Standoff = namedtuple('Standoff', 'start end type')
+
+class FormatError(Exception):
+    pass
+
+def _uint32_array(values=()):
+    for code in ('I', 'L'):
+        if array(code).itemsize == 4:
+            return array(code, values)
+    raise RuntimeError('no 32-bit unsigned array type on this platform')
+
+def _to_little_endian(a):
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+def write_spans(path, standoffs):
+    """Write standoffs with start, end and type to span file."""
+    type_ids, types = {}, []
+    starts, ends, ids = _uint32_array(), _uint32_array(), _uint32_array()
+    for so in standoffs:
+        if so.type not in type_ids:
+            type_ids[so.type] = len(types)
+            types.append(so.type)
+        starts.append(so.start)
+        ends.append(so.end)
+        ids.append(type_ids[so.type])
+    strings, offsets = [], _uint32_array([0])
+    for t in types:
+        if not isinstance(t, unicode):
+            t = str(t).decode('utf-8')
+        strings.append(t.encode('utf-8'))
+        offsets.append(offsets[-1] + len(strings[-1]))
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(_header.pack(MAGIC, len(starts), len(types)))
+        for a in (starts, ends, ids, offsets):
+            f.write(_to_little_endian(a).tostring())
+        f.write(''.join(strings))
+    os.rename(tmp, path)
+
+def is_span_file(path):
+    """Return True if path names a span file."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+class SpanFile(object):
+    """Read-only, memory-mapped span file.
+
+    Acts as a sequence of Standoff tuples. Indexing reads single
+    standoffs from the mapping; standoffs() converts all at once.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < _header.size:
+            raise FormatError('%s: truncated header' % path)
+        magic, self.count, ntypes = _header.unpack_from(self._map)
+        if magic != MAGIC:
+            raise FormatError('%s: not a span file' % path)
+        self._columns = _header.size
+        offsets_start = self._columns + 3*4*self.count
+        strings_start = offsets_start + 4*(ntypes+1)
+        if len(self._map) < strings_start:
+            raise FormatError('%s: truncated' % path)
+        offsets = self._column(offsets_start, ntypes+1)
+        self.types = [
+            self._map[strings_start+offsets[i]:strings_start+offsets[i+1]]
+            .decode('utf-8') for i in range(ntypes)
+        ]
+
+    def _column(self, start, count):
+        a = _uint32_array()
+        a.fromstring(self._map[start:start+4*count])
+        return _to_little_endian(a)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('span index out of range')
+        step = 4*self.count
+        start, = struct.unpack_from('<I', self._map, self._columns + 4*i)
+        end, = struct.unpack_from('<I', self._map, self._columns + step + 4*i)
+        type_id, = struct.unpack_from('<I', self._map,
+                                      self._columns + 2*step + 4*i)
+        return Standoff(start, end, self.types[type_id])
+
+    def columns(self):
+        """Return arrays of starts, ends and type indices."""
+        step = 4*self.count
+        return (self._column(self._columns, self.count),
+                self._column(self._columns + step, self.count),
+                self._column(self._columns + 2*step, self.count))
+
+    def standoffs(self):
+        """Return list of all standoffs."""
+        starts, ends, ids = self.columns()
+        types = self.types
+        return map(Standoff._make, zip(starts.tolist(), ends.tolist(),
+                                       [types[i] for i in ids]))
+
+    def close(self):
+        self._map.close()
+
+def read_spans(path):
+    """Return list of standoffs in span file."""
+    spans = SpanFile(path)
+    try:
+        return spans.standoffs()
+    finally:
+        spans.close()
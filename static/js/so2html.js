@@ -0,0 +1,173 @@
+/*
+ * Client-side renderer for text and span data generated by
+ * so2html.standoff_to_client_html(). Generates the same markup as
+ * so2html._render_spans() for spans with precomputed heights.
+ */
+
+var so2html = (function() {
+    'use strict';
+
+    // the tag to use to mark annotated spans (see so2html.TAG)
+    var TAG = 'span';
+
+    // "effectively zero" height for formatting tags
+    var EPSILON = 0.0001;
+
+    function Marker(span, offset, isEnd, contLeft) {
+        this.span = span;
+        this.offset = offset;
+        this.isEnd = isEnd;
+        this.contLeft = !!contLeft;
+        this.contRight = false;
+        this.coveredLeft = false;
+        this.coveredRight = false;
+        // at identical offsets, ending markers sort highest-last,
+        // starting markers highest-first.
+        this.sortIdx = span.sortHeight * (isEnd ? 1 : -1);
+        // store current start marker in span to allow ending markers
+        // to affect tag style
+        if (!isEnd) {
+            span.startMarker = this;
+        }
+    }
+
+    function markerSort(a, b) {
+        return (a.offset - b.offset) || (a.sortIdx - b.sortIdx);
+    }
+
+    function tag(span) {
+        if (span.type.tag !== null) {
+            return span.type.tag;
+        } else if (span.type.href !== null && span.height === 0) {
+            return 'a';
+        } else {
+            return TAG;
+        }
+    }
+
+    function markerString(m, tooltips) {
+        var span = m.span;
+        if (m.isEnd) {
+            return '</' + tag(span) + '>';
+        } else if (span.formatting) {
+            return '<' + tag(span) + '>';
+        }
+        var classes = tooltips ? ['hint--top'] : [];
+        classes.push('ann', 'ann-h' + span.height, 'ann-t' + span.type.cls);
+        if (m.contLeft) {
+            classes.push('ann-contleft');
+        }
+        if (m.contRight) {
+            classes.push('ann-conright');
+        }
+        if (m.coveredLeft) {
+            classes.push('ann-openleft');
+        }
+        if (m.coveredRight) {
+            classes.push('ann-openright');
+        }
+        var attributes = ['class="' + classes.join(' ') + '"'];
+        if (tooltips) {
+            attributes.push('data-hint="' + span.hint + '"');
+        }
+        if (span.type.href !== null) {
+            attributes.push('href="' + span.type.href + '"');
+            attributes.push('target="_blank"');
+        }
+        return '<' + tag(span) + ' ' + attributes.join(' ') + '>';
+    }
+
+    function render(payload) {
+        // Offsets count code points, not UTF-16 code units.
+        var text = Array.from(payload.text);
+        var columns = payload.spans, tooltips = payload.tooltips;
+        var markers = [], i, j;
+
+        for (i = 0; i < columns.start.length; i++) {
+            var type = payload.types[columns.type[i]];
+            var span = {
+                start: columns.start[i],
+                end: columns.end[i],
+                type: type,
+                formatting: type.tag !== null,
+                height: columns.height[i],
+                hint: tooltips ? payload.hints[columns.hint[i]] : null,
+                startMarker: null
+            };
+            span.sortHeight = (span.formatting ? span.height + 1 + EPSILON :
+                               span.height);
+            markers.push(new Marker(span, span.start, false));
+            markers.push(new Marker(span, span.end, true));
+        }
+        markers.sort(markerSort);
+
+        // process markers to generate additional start and end markers
+        // for instances where naively generated spans would cross.
+        var o = 0, out = [], openSpans = [];
+        i = 0;
+        while (i < markers.length) {
+            if (o !== markers[i].offset) {
+                out.push(text.slice(o, markers[i].offset).join(''));
+            }
+            o = markers[i].offset;
+
+            var toOpen = [], toClose = [], maxChangeHeight = -1, last = i;
+            for (j = i; j < markers.length && markers[j].offset === o; j++) {
+                (markers[j].isEnd ? toClose : toOpen).push(markers[j]);
+                maxChangeHeight = Math.max(maxChangeHeight,
+                                           markers[j].span.height);
+                last = j;
+            }
+
+            var minCoverHeight = Infinity;
+            openSpans.forEach(function(s) {
+                if (s.height < maxChangeHeight && s.end !== o) {
+                    s.startMarker.contRight = true;
+                    toOpen.push(new Marker(s, o, false, true));
+                    toClose.push(new Marker(s, o, true));
+                    minCoverHeight = Math.min(minCoverHeight, s.height);
+                }
+            });
+
+            toOpen.forEach(function(m) {
+                if (m.span.height > minCoverHeight) {
+                    m.coveredLeft = true;
+                }
+            });
+            toClose.forEach(function(m) {
+                if (m.span.height > minCoverHeight) {
+                    m.span.startMarker.coveredRight = true;
+                }
+            });
+
+            toOpen.sort(markerSort);
+            toClose.sort(markerSort);
+
+            toClose.forEach(function(m) {
+                out.push(m);
+                openSpans.splice(openSpans.indexOf(m.span), 1);
+            });
+            toOpen.forEach(function(m) {
+                out.push(m);
+                openSpans.push(m.span);
+            });
+
+            i = last + 1;
+        }
+        out.push(text.slice(o).join(''));
+
+        return out.map(function(item) {
+            return typeof item === 'string' ? item :
+                markerString(item, tooltips);
+        }).join('');
+    }
+
+    function renderInto(element, payload) {
+        element.innerHTML = render(payload);
+    }
+
+    return {
+        render: render,
+        renderInto: renderInto
+    };
+})();
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+"""On-disk cache of document texts for the RESTful Open Annotation explorer.
+
+Texts are stored UTF-8 encoded in files named by the SHA-1 digest of
+their content, each with a sidecar index of the byte offsets of every
+STEP-th character. This allows ranges of texts to be read through
+memory mapping without decoding the whole file. The total size of
+cached texts is bounded, with least recently used texts evicted
+first.
+
+Several processes (e.g. server workers) can share a cache directory:
+updates to the index are made under a file lock on the current
+index, and processes reload the index when another one changes it.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import os
+import json
+import errno
+import mmap
+import time
+import hashlib
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # no locking; directory must not be shared
+
+from array import array
+from contextlib import contextmanager
+
+# Number of characters between byte offsets stored in the index files.
+STEP = 4096
+
+# Name of file mapping URLs to cache entries.
+INDEX_FILE = 'index.json'
+
+# Name of file locked for updates to the index.
+LOCK_FILE = 'index.lock'
+
+class TextCache(object):
+    """Size-bounded, content-addressed on-disk cache of document texts.
+
+    Entries are dicts with the keys 'digest', 'length' (in characters),
+    'size' (in bytes), 'encoding' (as resolved when fetching),
+    'etag', 'last_modified' (validators for conditional requests),
+    'validated' and 'accessed' (times in seconds since the epoch).
+    """
+
+    def __init__(self, directory, max_bytes=1024**3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Access times not yet saved in the index, by URL.
+        self._accessed = {}
+        self._entries, self._version = {}, None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._reload()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _text_path(self, digest):
+        return self._path(digest + '.txt')
+
+    def _index_path(self, digest):
+        return self._path(digest + '.idx')
+
+    def get(self, url):
+        """Return entry for given URL, or None if not cached."""
+        with self._lock:
+            self._reload()
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            if not os.path.exists(self._text_path(entry['digest'])):
+                # removed from outside
+                return None
+            self._accessed[url] = entry['accessed'] = time.time()
+            return dict(entry)
+
+    def validated(self, url):
+        """Record that the cached text for URL was found to be current."""
+        with self._lock, self._locked_index():
+            if url in self._entries:
+                self._entries[url]['validated'] = time.time()
+                self._save()
+
+    def put(self, url, text, encoding=None, etag=None, last_modified=None):
+        """Store text for given URL, returning the new entry."""
+        data = text.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        offsets, position = array('L'), 0
+        for i in range(0, len(text), STEP):
+            offsets.append(position)
+            position += len(text[i:i+STEP].encode('utf-8'))
+        now = time.time()
+        entry = {
+            'digest': digest,
+            'length': len(text),
+            'size': len(data),
+            'encoding': encoding,
+            'etag': etag,
+            'last_modified': last_modified,
+            'validated': now,
+            'accessed': now,
+        }
+        with self._lock, self._locked_index():
+            # Files are written under the lock so that other processes
+            # don't evict them before the entry is added.
+            if not os.path.exists(self._text_path(digest)):
+                self._write(self._index_path(digest), offsets.tostring())
+                self._write(self._text_path(digest), data)
+            self._entries[url] = entry
+            self._evict()
+            self._save()
+        return dict(entry)
+
+    def text(self, entry, start=0, end=None):
+        """Return text of given entry, or range [start, end) of it.
+
+        Returns None if the text has been evicted since the entry was
+        returned, which callers should treat as a cache miss.
+        """
+        if end is None or end > entry['length']:
+            end = entry['length']
+        if start >= end:
+            return u''
+        try:
+            with open(self._index_path(entry['digest']), 'rb') as f:
+                offsets = array('L')
+                offsets.fromstring(f.read())
+            f = open(self._text_path(entry['digest']), 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        first, last = start // STEP, (end + STEP - 1) // STEP
+        with f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if last < len(offsets):
+                    byte_end = offsets[last]
+                else:
+                    byte_end = len(mapped)
+                chunk = mapped[offsets[first]:byte_end].decode('utf-8')
+            finally:
+                mapped.close()
+        return chunk[start-first*STEP:end-first*STEP]
+
+    def _write(self, path, data):
+        # Write via temporary file and rename so that readers never
+        # see partial files.
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def _reload(self):
+        """Read the index if another process has changed it."""
+        try:
+            st = os.stat(self._path(INDEX_FILE))
+        except OSError:
+            return
+        version = (st.st_ino, st.st_mtime, st.st_size)
+        if version == self._version:
+            return
+        try:
+            with open(self._path(INDEX_FILE)) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return
+        for url, accessed in self._accessed.iteritems():
+            if url in entries:
+                entries[url]['accessed'] = max(entries[url]['accessed'],
+                                               accessed)
+        self._entries, self._version = entries, version
+
+    @contextmanager
+    def _locked_index(self):
+        """Lock the index for update by this process and reload it."""
+        with open(self._path(LOCK_FILE), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            self._reload()
+            yield
+
+    def _save(self):
+        self._write(self._path(INDEX_FILE), json.dumps(self._entries))
+        self._accessed = {}
+        st = os.stat(self._path(INDEX_FILE))
+        self._version = (st.st_ino, st.st_mtime, st.st_size)
+
+    def _evict(self):
+        """Remove least recently used entries until within max_bytes."""
+        sizes, references = {}, {}
+        for entry in self._entries.itervalues():
+            digest = entry['digest']
+            sizes[digest] = entry['size']
+            references[digest] = references.get(digest, 0) + 1
+        total = sum(sizes.itervalues())
+        by_access = sorted(self._entries.items(),
+                           key=lambda i: i[1]['accessed'])
+        for url, entry in by_access:
+            if total <= self.max_bytes:
+                break
+            del self._entries[url]
+            digest = entry['digest']
+            references[digest] -= 1
+            if references[digest] > 0:
+                continue # content shared with another URL
+            total -= sizes[digest]
+            for path in (self._text_path(digest), self._index_path(digest)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""Per-host scheduling of upstream requests for the RESTful Open
+Annotation explorer.
+
+Each upstream host has a limit on requests in flight, adapted to how
+the host copes: the limit grows by about one per round of requests
+completed within the target latency and halves on errors or slow
+responses (additive increase, multiplicative decrease). Requests over
+the limit wait in a bounded queue until a deadline.
+
+Limits are per scheduler, and so per process: N server workers
+together send up to N times the limit to a host.
+"""
+
+__author__ = 'Sampo Pyysalo'
+__license__ = 'MIT'
+
+import time
+import urlparse
+import threading
+
+from contextlib import contextmanager
+
+class UpstreamBusy(Exception):
+    """Raised when a request can't be sent to a host in time."""
+    pass
+
+class _Host(object):
+    """Limit, queue and latency statistics for one host."""
+
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self.latency = None # exponentially weighted moving average
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.decreased = 0 # time of last decrease
+        self.condition = threading.Condition()
+
+class Slot(object):
+    """Permission to send one request. Set error to True if the
+    response indicates that the host is overloaded, and call
+    responded() when the response starts to arrive to measure latency
+    without transfer time."""
+
+    def __init__(self):
+        self.error = False
+        self.started = time.time()
+        self.latency = None
+
+    def responded(self):
+        self.latency = time.time() - self.started
+
+class UpstreamScheduler(object):
+    """Adaptive per-host concurrency limits for upstream requests."""
+
+    def __init__(self, initial=4, min_limit=1, max_limit=32,
+                 target_latency=2.0, queue_size=100, queue_timeout=10,
+                 smoothing=0.2):
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.smoothing = smoothing
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host(self, url):
+        name = urlparse.urlparse(url).netloc
+        with self._lock:
+            if name not in self._hosts:
+                self._hosts[name] = _Host(self.initial)
+            return self._hosts[name]
+
+    @contextmanager
+    def slot(self, url, timeout=None, ignore=()):
+        """Context manager waiting for a free slot for the host of url
+        for at most timeout seconds (default queue_timeout).
+
+        Raises UpstreamBusy if the queue is full or time runs out.
+        Exceptions raised in the context count as errors unless they
+        are instances of the classes in ignore.
+        """
+        host = self._host(url)
+        if timeout is None:
+            timeout = self.queue_timeout
+        self._acquire(host, time.time() + timeout)
+        slot = Slot()
+        try:
+            yield slot
+        except Exception, e:
+            if not isinstance(e, ignore):
+                slot.error = True
+            raise
+        finally:
+            if slot.latency is None:
+                slot.responded()
+            self._release(host, slot.latency, slot.error)
+
+    def _acquire(self, host, deadline):
+        with host.condition:
+            if host.in_flight >= int(host.limit):
+                if host.waiting >= self.queue_size:
+                    host.rejected += 1
+                    raise UpstreamBusy('upstream queue full')
+                host.waiting += 1
+                try:
+                    while host.in_flight >= int(host.limit):
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            host.rejected += 1
+                            raise UpstreamBusy('upstream busy')
+                        host.condition.wait(remaining)
+                finally:
+                    host.waiting -= 1
+            host.in_flight += 1
+
+    def _release(self, host, latency, error):
+        with host.condition:
+            host.in_flight -= 1
+            host.requests += 1
+            if host.latency is None:
+                host.latency = latency
+            else:
+                host.latency += self.smoothing * (latency - host.latency)
+            now = time.time()
+            if error or latency > self.target_latency:
+                if error:
+                    host.errors += 1
+                # Decrease at most once per round trip, as requests in
+                # flight together tend to fail together.
+                if now - host.decreased > host.latency:
+                    host.limit = max(self.min_limit, host.limit / 2)
+                    host.decreased = now
+            else:
+                host.limit = min(self.max_limit, host.limit + 1/host.limit)
+            host.condition.notify_all()
+
+    def stats(self):
+        """Return dict of per-host limits, queue depths and latencies."""
+        with self._lock:
+            hosts = self._hosts.items()
+        return {
+            name: {
+                'limit': int(h.limit),
+                'in_flight': h.in_flight,
+                'waiting': h.waiting,
+                'latency': h.latency,
+                'requests': h.requests,
+                'errors': h.errors,
+                'rejected': h.rejected,
+            } for name, h in hosts
+        }